@@ -0,0 +1,364 @@
+__author__ = 'nikita_kartashov'
+
+import sys
+import os
+import gc
+import json
+import platform
+import subprocess
+import tracemalloc
+from os import path
+from io import StringIO
+from random import Random
+from time import perf_counter
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+from bg.bg_io import GRIMMReader
+
+from src.graph import statistics, fast_statistics
+from src.graph.fast_statistics import get_adjacency_graph
+from src.graph.chain_contraction import get_contracted_graph, get_pattern_core
+
+from .metric_runner import TOPOLOGIES, BACKEND_METRICS
+from .metrics.metrics import REFERENCE_BACKEND, ACCELERATED_BACKEND, CONTRACTED_BACKEND, BACKENDS
+from .benchmark_startup import get_project_environment
+
+# Benchmarks run on synthetic datasets: four genomes of the given number of blocks evolved by reversals
+# along the ((A, B), (C, D)) tree, the same way for every run, so that results of different runs are comparable.
+# Every benchmark is timed several times and then run once more under tracemalloc for its peak memory,
+# the end-to-end run of compare_methods reports the peak RSS of its processes instead.
+
+DEFAULT_SIZES = (100, 1000, 5000)
+DEFAULT_REPEATS = 5
+DATASET_SEED = 4
+# Reversals per block on the inner edge and on every leaf edge of the tree
+INNER_REVERSAL_RATE = 0.05
+LEAF_REVERSAL_RATE = 0.025
+END_TO_END_FOLDERS = ('1_10_5', '2_20_10')
+END_TO_END_FILES = 4
+# Whole compare_methods runs take long, so they are repeated at most this many times
+END_TO_END_REPEATS = 3
+
+DEFAULT_TIME_THRESHOLD = 0.2
+DEFAULT_MEMORY_THRESHOLD = 0.2
+# Differences below these are noise whatever the ratio is
+MIN_TIME_DIFFERENCE = 0.005
+MIN_MEMORY_DIFFERENCE = 64 * 1024
+
+BENCHMARKED_SINGLE_METRICS = (('CA', statistics.get_ca_metric),
+                              ('MCA', statistics.get_mca_metric),
+                              ('D', statistics.get_distribution_metric),
+                              ('SP', statistics.get_simple_paths_metric),
+                              ('S_BP', statistics.get_bp_distance_metric),
+                              ('S_DCJ', statistics.get_dcj_distance_metric))
+
+BENCHMARKED_BATCH_METRICS = (('MCA+', statistics.get_cumulative_metric_batch),
+                             ('cylinder', statistics.get_cylinder_pattern_metric_batch),
+                             ('bag', statistics.get_bag_pattern_metric_batch),
+                             ('diamond', statistics.get_diamond_pattern_metric_batch))
+
+PATTERN_FINDERS = {
+    REFERENCE_BACKEND: (('cylinder', statistics.find_cylinder_patterns),
+                        ('bag', statistics.find_bag_patterns),
+                        ('diamond', statistics.find_diamond_patterns)),
+    ACCELERATED_BACKEND: (('cylinder', fast_statistics.find_cylinder_patterns),
+                          ('bag', fast_statistics.find_bag_patterns),
+                          ('diamond', fast_statistics.find_diamond_patterns)),
+}
+# Contracted pattern metrics search only the part of the graph which patterns may lie in
+PATTERN_FINDERS[CONTRACTED_BACKEND] = tuple(
+    (name, lambda breakpoint_graph, find_patterns=find_patterns: find_patterns(get_pattern_core(breakpoint_graph)))
+    for name, find_patterns in PATTERN_FINDERS[ACCELERATED_BACKEND])
+
+
+def reverse_random_segment(genome, random):
+    i, j = sorted(random.sample(range(len(genome) + 1), 2))
+    genome[i:j] = [-block for block in reversed(genome[i:j])]
+
+
+def evolve(genome, reversal_number, random):
+    genome = list(genome)
+    for _ in range(reversal_number):
+        reverse_random_segment(genome, random)
+    return genome
+
+
+def generate_blocks(size, seed=DATASET_SEED):
+    """
+    Generates a block file of four single-chromosome genomes, A and B being siblings as well as C and D
+    :param size: number of blocks in every genome
+    :param seed: seed of the reversals
+    :return: contents of the block file in GRIMM format
+    """
+    random = Random('{0}_{1}'.format(seed, size))
+    inner_reversals = max(1, int(size * INNER_REVERSAL_RATE))
+    leaf_reversals = max(1, int(size * LEAF_REVERSAL_RATE))
+    root = list(range(1, size + 1))
+    left = evolve(root, inner_reversals // 2, random)
+    right = evolve(root, inner_reversals - inner_reversals // 2, random)
+    genomes = (('A', left), ('B', left), ('C', right), ('D', right))
+    return ''.join('>{0}\n{1} $\n'.format(name, ' '.join(map(str, evolve(parent, leaf_reversals, random))))
+                   for name, parent in genomes)
+
+
+def write_dataset(root_directory, size, file_number=END_TO_END_FILES):
+    """
+    Writes a dataset in the layout compare_methods expects: run_e1_e2/i/blocks.txt and correct_tree.newick
+    """
+    for folder_number, folder in enumerate(END_TO_END_FOLDERS):
+        for i in range(file_number):
+            file_directory = path.join(root_directory, folder, str(i))
+            os.makedirs(file_directory)
+            with open(path.join(file_directory, 'blocks.txt'), 'w') as block_file:
+                block_file.write(generate_blocks(size, '{0}_{1}_{2}'.format(DATASET_SEED, folder_number, i)))
+            with open(path.join(file_directory, 'correct_tree.newick'), 'w') as tree_file:
+                tree_file.write("(('A', 'B'), ('C', 'D'));\n")
+
+
+def parse_blocks(blocks):
+    return GRIMMReader.get_breakpoint_graph(StringIO(blocks))
+
+
+def build_index(breakpoint_graph, backend):
+    if backend != REFERENCE_BACKEND:
+        get_adjacency_graph(breakpoint_graph)
+    if backend == CONTRACTED_BACKEND:
+        get_contracted_graph(breakpoint_graph)
+        get_pattern_core(breakpoint_graph)
+
+
+def get_prepared_graph(blocks, backend):
+    """
+    Parses the blocks and builds the index of the backend, so that metric timings do not include them
+    """
+    breakpoint_graph = parse_blocks(blocks)
+    build_index(breakpoint_graph, backend)
+    return breakpoint_graph
+
+
+def measure(setup, run, repeats):
+    """
+    Times a function and measures the peak of memory it allocates
+    :param setup: function preparing the argument of run, it is neither timed nor traced
+    :param run: benchmarked function of one argument
+    :param repeats: number of timed runs
+    :return: dict with sorted timings, the fastest of them, which is the least noisy, and peak traced memory in bytes
+    """
+    timings = []
+    for _ in range(repeats):
+        argument = setup()
+        gc.collect()
+        start = perf_counter()
+        run(argument)
+        timings.append(perf_counter() - start)
+
+    argument = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run(argument)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    timings.sort()
+    return {'time': timings[0], 'timings': timings, 'memory': peak_memory}
+
+
+def measure_command(command, repeats, cwd):
+    """
+    Times a command and measures the peak resident memory of its processes
+    """
+    timings, peak_memory = [], 0
+    for _ in range(repeats):
+        start = perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, env=get_project_environment(),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Usage of the reaped child includes the usage of its own reaped children, e.g. pool workers
+        _, status, usage = os.wait4(process.pid, 0)
+        timings.append(perf_counter() - start)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        # Linux reports kilobytes
+        peak_memory = max(peak_memory, usage.ru_maxrss * 1024)
+    timings.sort()
+    return {'time': timings[0], 'timings': timings, 'memory': peak_memory}
+
+
+def get_benchmarks(sizes, backend):
+    """
+    :return: generator of (benchmark name, function taking the number of repeats and returning its measurement)
+    """
+    implementations = BACKEND_METRICS.get(backend, {})
+    pattern_finders = PATTERN_FINDERS.get(backend, PATTERN_FINDERS[ACCELERATED_BACKEND])
+    for size in sizes:
+        blocks = generate_blocks(size)
+        prepared_graph = lambda blocks=blocks: get_prepared_graph(blocks, backend)
+
+        yield 'parse/{0}'.format(size), lambda repeats, blocks=blocks: measure(lambda: blocks, parse_blocks, repeats)
+        if backend != REFERENCE_BACKEND:
+            yield 'index/{0}'.format(size), lambda repeats, blocks=blocks: measure(
+                lambda: parse_blocks(blocks), lambda breakpoint_graph: build_index(breakpoint_graph, backend), repeats)
+
+        for name, metric in BENCHMARKED_SINGLE_METRICS:
+            metric = implementations.get(metric, metric)
+            yield 'metric/{0}/{1}'.format(name, size), lambda repeats, metric=metric, prepared_graph=prepared_graph: \
+                measure(prepared_graph, lambda breakpoint_graph: [metric(breakpoint_graph, topology)
+                                                                  for topology in TOPOLOGIES], repeats)
+        for name, metric in BENCHMARKED_BATCH_METRICS:
+            metric = implementations.get(metric, metric)
+            yield 'metric/{0}/{1}'.format(name, size), lambda repeats, metric=metric, prepared_graph=prepared_graph: \
+                measure(prepared_graph, lambda breakpoint_graph: list(metric(breakpoint_graph, TOPOLOGIES)), repeats)
+        for name, find_patterns in pattern_finders:
+            yield 'find/{0}/{1}'.format(name, size), lambda repeats, find_patterns=find_patterns, \
+                prepared_graph=prepared_graph: measure(prepared_graph, find_patterns, repeats)
+
+    for size in sizes:
+        yield 'compare_methods/{0}'.format(size), lambda repeats, size=size: measure_end_to_end(size, backend, repeats)
+
+
+def measure_end_to_end(size, backend, repeats):
+    # compare_methods logs into its working directory, so it runs inside the temporary one
+    with TemporaryDirectory() as working_directory:
+        dataset_root = path.join(working_directory, 'dataset')
+        write_dataset(dataset_root, size)
+        return measure_command([sys.executable, '-m', 'src.compare_methods', dataset_root, '--backend', backend],
+                               min(repeats, END_TO_END_REPEATS), working_directory)
+
+
+def get_machine():
+    return {'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version()}
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, backend=REFERENCE_BACKEND, repeats=DEFAULT_REPEATS, name_filter=None,
+                   log=sys.stderr):
+    """
+    Runs the benchmark suite
+    :param sizes: numbers of blocks in the benchmarked genomes
+    :param backend: metric backend to benchmark
+    :param repeats: number of timed runs of every benchmark
+    :param name_filter: only benchmarks which names contain this string are run
+    :param log: stream progress is written to
+    :return: dict of the machine, the settings and the results by benchmark name, as saved into baselines
+    """
+    results = {}
+    for name, benchmark in get_benchmarks(sizes, backend):
+        if name_filter is not None and name_filter not in name:
+            continue
+        results[name] = benchmark(repeats)
+        print('{0}\t{1:.4f}s\t{2}KB'.format(name.ljust(28), results[name]['time'],
+                                            results[name]['memory'] // 1024), file=log)
+    return {'machine': get_machine(), 'backend': backend, 'repeats': repeats, 'results': results}
+
+
+def compare_results(baseline, current, time_threshold=DEFAULT_TIME_THRESHOLD,
+                    memory_threshold=DEFAULT_MEMORY_THRESHOLD):
+    """
+    Compares results of two runs of the suite
+    :param baseline: results saved earlier
+    :param current: results to check
+    :param time_threshold: relative increase of the fastest time which is a regression
+    :param memory_threshold: relative increase of the peak memory which is a regression
+    :return: list of (benchmark name, baseline measurement, current measurement, list of regressed quantities)
+    for benchmarks present in both
+    """
+    thresholds = (('time', time_threshold, MIN_TIME_DIFFERENCE), ('memory', memory_threshold, MIN_MEMORY_DIFFERENCE))
+    comparison = []
+    for name, baseline_result in baseline['results'].items():
+        if name not in current['results']:
+            continue
+        current_result = current['results'][name]
+        regressions = [quantity for quantity, threshold, min_difference in thresholds
+                       if current_result[quantity] > baseline_result[quantity] * (1 + threshold) and
+                       current_result[quantity] - baseline_result[quantity] > min_difference]
+        comparison.append((name, baseline_result, current_result, regressions))
+    return comparison
+
+
+def print_comparison(baseline, current, comparison, out=sys.stdout):
+    """
+    :return: True if there are no regressions
+    """
+    if baseline['machine'] != current['machine'] or baseline['backend'] != current['backend']:
+        print('Warning: the baseline was measured on {0} with the {1} backend, the results on {2} with the {3} one'.
+              format(baseline['machine'], baseline['backend'], current['machine'], current['backend']), file=sys.stderr)
+
+    def ratio(quantity, baseline_result, current_result):
+        return current_result[quantity] / baseline_result[quantity] if baseline_result[quantity] else float('inf')
+
+    for name, baseline_result, current_result, regressions in comparison:
+        print('{0}\ttime {1:.4f}s -> {2:.4f}s (x{3:.2f})\tmemory {4}KB -> {5}KB (x{6:.2f})\t{7}'.format(
+            name.ljust(28), baseline_result['time'], current_result['time'],
+            ratio('time', baseline_result, current_result),
+            baseline_result['memory'] // 1024, current_result['memory'] // 1024,
+            ratio('memory', baseline_result, current_result),
+            'REGRESSION: ' + ', '.join(regressions) if regressions else 'ok'), file=out)
+    missing = sorted(set(baseline['results']) - set(current['results']))
+    if missing:
+        print('Not measured: {0}'.format(', '.join(missing)), file=out)
+    regression_number = sum(1 for _, _, _, regressions in comparison if regressions)
+    print('{0} of {1} benchmarks regressed'.format(regression_number, len(comparison)), file=out)
+    return regression_number == 0
+
+
+def load_results(results_path):
+    with open(results_path) as results_file:
+        return json.load(results_file)
+
+
+def save_results(results, results_path):
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Benchmarks metrics, parsing and compare_methods, '
+                                        'saves JSON baselines and compares runs against them')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the suite')
+    run_parser.add_argument('--output', '-o', default=None, help='save the results into this JSON file')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                            help='numbers of blocks in the benchmarked genomes')
+    run_parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='timed runs of every benchmark')
+    run_parser.add_argument('--backend', choices=BACKENDS, default=REFERENCE_BACKEND, help='metric backend')
+    run_parser.add_argument('--filter', default=None, help='run only benchmarks which names contain this string')
+    run_parser.add_argument('--baseline', default=None, help='compare the results against this JSON baseline')
+
+    compare_parser = subparsers.add_parser('compare', help='compare saved results against a baseline')
+    compare_parser.add_argument('baseline', help='JSON baseline')
+    compare_parser.add_argument('results', help='JSON results to check')
+
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument('--time-threshold', type=float, default=DEFAULT_TIME_THRESHOLD,
+                               help='relative increase of the fastest time reported as a regression')
+        subparser.add_argument('--memory-threshold', type=float, default=DEFAULT_MEMORY_THRESHOLD,
+                               help='relative increase of the peak memory reported as a regression')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    if arguments.command == 'run':
+        current = run_benchmarks(arguments.sizes, arguments.backend, arguments.repeats, arguments.filter)
+        if arguments.output is not None:
+            save_results(current, arguments.output)
+        if arguments.baseline is None:
+            return
+        baseline = load_results(arguments.baseline)
+    else:
+        baseline, current = load_results(arguments.baseline), load_results(arguments.results)
+
+    comparison = compare_results(baseline, current, arguments.time_threshold, arguments.memory_threshold)
+    if not print_comparison(baseline, current, comparison):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+__author__ = 'nikita_kartashov'
+
+from sys import argv, executable
+from os import path, environ
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+import signal
+import subprocess
+
+from .metric_client import request_folders
+
+PROJECT_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+BENCHMARK_SOCKET_PATH = '/tmp/4genome_tester_benchmark.sock'
+SERVER_START_TIMEOUT = 60
+DEFAULT_REPEATS = 10
+
+
+def get_project_environment():
+    """
+    Environment letting project modules run from any directory, so that the logs they write stay out of the project
+    """
+    return dict(environ, PYTHONPATH=PROJECT_ROOT)
+
+
+def time_command(command, working_directory):
+    start = perf_counter()
+    subprocess.run(command, cwd=working_directory, env=get_project_environment(), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return perf_counter() - start
+
+
+def time_request(block_folder_path, socket_path):
+    start = perf_counter()
+    for _ in request_folders([block_folder_path], socket_path):
+        pass
+    return perf_counter() - start
+
+
+def start_server(socket_path, working_directory):
+    """
+    Starts a metric server and waits until it accepts connections
+    :param socket_path: socket the server should listen on
+    :param working_directory: directory the server runs and logs in
+    :return: server process and time it took to become ready
+    """
+    start = perf_counter()
+    server = subprocess.Popen([executable, '-m', 'src.metric_server', socket_path], cwd=working_directory,
+                              env=get_project_environment())
+    while perf_counter() - start < SERVER_START_TIMEOUT:
+        if path.exists(socket_path):
+            # Empty request: the server answers with the header only
+            for _ in request_folders([], socket_path):
+                pass
+            return server, perf_counter() - start
+        sleep(0.05)
+    server.kill()
+    raise RuntimeError('Metric server has not started in {0} seconds'.format(SERVER_START_TIMEOUT))
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print('{0}\tmin={1:.3f}s\tmedian={2:.3f}s\tmean={3:.3f}s'.format(
+        name.ljust(24), timings[0], timings[len(timings) // 2], sum(timings) / len(timings)))
+
+
+def benchmark_startup(block_folder_path, repeats=DEFAULT_REPEATS):
+    """
+    Compares latency of scoring one folder with the one-shot CLI and with a warm server
+    :param block_folder_path: folder with block files, named like run_e1_e2
+    :param repeats: number of runs of every variant
+    """
+    block_folder_path = path.abspath(block_folder_path)
+    input_folder, folder = path.split(block_folder_path)
+
+    # The CLI and the server log into their working directory
+    with TemporaryDirectory() as working_directory:
+        one_shot = [time_command([executable, '-m', 'src.compare_methods', input_folder, folder], working_directory)
+                    for _ in range(repeats)]
+
+        server, server_start = start_server(BENCHMARK_SOCKET_PATH, working_directory)
+        try:
+            client = [time_command([executable, '-m', 'src.metric_client', BENCHMARK_SOCKET_PATH, block_folder_path],
+                                   working_directory)
+                      for _ in range(repeats)]
+            in_process = [time_request(block_folder_path, BENCHMARK_SOCKET_PATH) for _ in range(repeats)]
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+    print('Server startup took {0:.3f}s'.format(server_start))
+    report('one-shot compare_methods', one_shot)
+    report('metric_client process', client)
+    report('in-process request', in_process)
+
+
+if __name__ == '__main__':
+    if len(argv) not in (2, 3):
+        print('Usage: python -m src.benchmark_startup <block folder> [repeats]')
+        exit(1)
+
+    benchmark_startup(argv[1], int(argv[2]) if len(argv) == 3 else DEFAULT_REPEATS)
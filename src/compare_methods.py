@@ -1,9 +1,13 @@
 __author__ = 'nikita_kartashov'
 
 import sys
-from sys import argv
-from os import path, walk, listdir
+from os import path
 from itertools import chain
+from functools import partial
+from random import random, shuffle
+from math import sqrt
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
 import logging as log
 import multiprocessing as mp
 from ast import literal_eval
@@ -16,18 +20,85 @@ PACKAGES_USED = ('graph', 'metrics', 'output')
 for package in PACKAGES_USED:
     sys.path.append(path.abspath(package))
 
-from .metric_runner import compare_metric_results, METRICS
+import numpy as np
+
+from .metric_runner import METRICS, TOPOLOGIES, get_right_topology_index, decide_if_right, get_accuracies
 from .output.stdout_printer import StdOutPrinter
+from .sharding import run_sharded_metrics, DEFAULT_SHARD_MIN_NODES, SHARDS_PER_PROCESS
+from .metrics.metrics import REFERENCE_BACKEND, stack_score_rows
+from .tracing import trace_file, merge_traces, DEFAULT_TOP_FILES
+from .compression import find_stored_name
+from .dataset_pack import walk_dataset, open_dataset_file, list_dataset_directory, is_dataset_directory, \
+    dataset_exists
 
 BLOCK_FILE_NAME = 'blocks.txt'
 CORRECT_TREE_FILE_NAME = 'correct_tree.newick'
-
-
-def run_metrics_on_block_file(block_path, full_correct_tree_file_name):
+FOLDER_HEADER = ('run', 'e1', 'e2')
+# Two-sided 95% confidence
+ACCURACY_Z_SCORE = 1.96
+# Adaptive scoring never stops a folder before this many files
+MIN_ADAPTIVE_FILE_NUMBER = 10
+# Every block has a head and a tail, so a graph has about two nodes per block
+NODES_PER_BLOCK = 2
+
+
+def count_blocks(block_file):
+    """
+    Counts distinct blocks of a GRIMM file without building its graph, which is much faster
+    :param block_file: text file-like object
+    :return: number of blocks
+    """
+    blocks = set()
+    for line in block_file:
+        line = line.split('#', 1)[0].strip()
+        if line and not line.startswith('>'):
+            blocks.update(token.lstrip('+-').rstrip('$@') for token in line.split())
+    blocks.discard('')
+    return len(blocks)
+
+
+def run_metrics_on_block_file(block_path, full_correct_tree_file_name, backend=None, verify_fraction=0,
+                              trace_directory=None, metrics_runner=None, max_nodes=None):
+    """
+    Scores the topologies on a block file
+    :param max_nodes: if given, graphs of about this many nodes or more are neither parsed nor scored
+    :return: (numpy array of scores, metrics x topologies, numpy array of their confidence half-widths,
+    zero for exact scores, index of the right topology in TOPOLOGIES), None for a graph which is too big
+    """
+    if max_nodes is not None:
+        with open_dataset_file(block_path) as block_file:
+            if NODES_PER_BLOCK * count_blocks(block_file) >= max_nodes:
+                return None
     correct_tree = read_correct_tree(full_correct_tree_file_name)
-    with open(block_path) as block_file:
-        breakpoint_graph = GRIMMReader.get_breakpoint_graph(block_file)
-        return compare_metric_results(breakpoint_graph, correct_tree)
+    with trace_file(block_path, trace_directory) as file_trace:
+        with file_trace.span('parse'), open_dataset_file(block_path) as block_file:
+            breakpoint_graph = GRIMMReader.get_breakpoint_graph(block_file)
+        file_trace.set_graph(breakpoint_graph)
+        if metrics_runner is not None:
+            # Sharded metrics are all scored at once, before any row is taken, so they get a span of their own
+            metrics_runner = file_trace.traced_call('shards', metrics_runner)
+        half_width_rows = []
+        score_matrix = METRICS.score_matrix(breakpoint_graph, TOPOLOGIES, backend, metrics_runner,
+                                            file_trace.traced_iteration, half_width_rows)
+        if verify_fraction > 0 and random() < verify_fraction:
+            with file_trace.span('verify'):
+                verify_metric_results(breakpoint_graph, block_path, score_matrix)
+        return score_matrix, stack_score_rows(half_width_rows, len(TOPOLOGIES)), get_right_topology_index(correct_tree)
+
+
+def verify_metric_results(breakpoint_graph, block_path, score_matrix):
+    """
+    Runs the metrics on the reference backend and reports every metric scoring differently
+    :param breakpoint_graph: BP graph read from the block file
+    :param block_path: path to the block file for the report
+    :param score_matrix: numpy array of the verified scores of the file, metrics x topologies
+    :return: number of mismatching metrics
+    """
+    mismatches = METRICS.find_mismatches(breakpoint_graph, TOPOLOGIES, score_matrix)
+    for annotation, reference_scores, checked_scores in mismatches:
+        log.error('Metric {0} differs from the reference in file {1}, expected={2}, real={3}'.
+                  format(annotation, block_path, reference_scores, checked_scores))
+    return len(mismatches)
 
 
 TREE_NODES = ['A', 'B', 'C', 'D']
@@ -35,7 +106,7 @@ TREE_NODES = ['A', 'B', 'C', 'D']
 
 def read_correct_tree(full_correct_tree_file_name):
     try:
-        with open(full_correct_tree_file_name) as correct_tree_file:
+        with open_dataset_file(full_correct_tree_file_name) as correct_tree_file:
             unparsed_tree = correct_tree_file.readline().strip().strip(';')
             for tree_node in TREE_NODES:
                 unparsed_tree.replace(tree_node, "'{0}'".format(tree_node))
@@ -45,29 +116,134 @@ def read_correct_tree(full_correct_tree_file_name):
         exit(2)
 
 
-def run_metrics_on_block_folder(block_folder_path):
-    for root_path, directory_names, file_names in walk(block_folder_path):
-        for block_file_name in (name for name in file_names if name == BLOCK_FILE_NAME):
-            full_name = path.join(root_path, block_file_name)
-            full_correct_tree_file_name = path.join(root_path, CORRECT_TREE_FILE_NAME)
-            yield run_metrics_on_block_file(full_name, full_correct_tree_file_name)
-
-
-def reduce_run_results(run_results):
-    result_sum = [0] * METRICS.metric_number()
-    result_number = 0
-    for result in run_results:
-        for i, e in enumerate(result):
-            result_sum[i] += e
-        result_number += 1
-
-    return result_sum, result_number
-
-
-def run_computation_on_folder(block_folder_path):
-    run_results = run_metrics_on_block_folder(block_folder_path)
-    metric_results, file_count = reduce_run_results(run_results)
-    return list(result * 1.0 / file_count for result in metric_results)
+def list_block_files(block_folder_path):
+    """
+    Lists block files under the folder along with their correct tree files, either may be compressed
+    :param block_folder_path: folder, possibly inside a pack
+    :return: generator of (block file path, correct tree file path)
+    """
+    for root_path, directory_names, file_names in walk_dataset(block_folder_path):
+        block_file_name = find_stored_name(BLOCK_FILE_NAME, file_names)
+        if block_file_name is not None:
+            correct_tree_file_name = find_stored_name(CORRECT_TREE_FILE_NAME, file_names) or CORRECT_TREE_FILE_NAME
+            yield path.join(root_path, block_file_name), path.join(root_path, correct_tree_file_name)
+
+
+def get_accuracy_interval_width(right_number, file_number, z_score=ACCURACY_Z_SCORE):
+    """
+    Returns width of the Wilson score interval of the accuracy, which unlike the normal one
+    does not collapse when a metric is right or wrong on every file so far
+    :param right_number: number of files the metric is right on
+    :param file_number: number of scored files
+    :param z_score: normal quantile of the confidence level
+    :return: width of the interval
+    """
+    accuracy = right_number * 1.0 / file_number
+    return 2 * z_score * sqrt(accuracy * (1 - accuracy) / file_number + z_score ** 2 / (4 * file_number ** 2)) / \
+        (1 + z_score ** 2 / file_number)
+
+
+def reduce_run_results(run_results, ci_width=None):
+    """
+    Stacks results of the metrics over the files
+    :param run_results: iterable of per file results, consumed lazily
+    :param ci_width: if given, stops once accuracy intervals of all metrics are narrower than that
+    :return: (numpy array of scores, files x metrics x topologies, numpy array of their confidence half-widths,
+    numpy array of right topology indices)
+    """
+    score_matrices, half_width_matrices, right_topology_indices = [], [], []
+    right_numbers = np.zeros(METRICS.metric_number(), dtype=int)
+    for score_matrix, half_width_matrix, right_topology_index in run_results:
+        score_matrices.append(score_matrix)
+        half_width_matrices.append(half_width_matrix)
+        right_topology_indices.append(right_topology_index)
+        if ci_width is None:
+            continue
+        right_numbers += decide_if_right(score_matrix[np.newaxis], [right_topology_index])[0]
+        if len(score_matrices) >= MIN_ADAPTIVE_FILE_NUMBER and \
+                all(get_accuracy_interval_width(right_number, len(score_matrices)) < ci_width
+                    for right_number in right_numbers):
+            break
+
+    return METRICS.stack_score_matrices(score_matrices, len(TOPOLOGIES)), \
+        METRICS.stack_score_matrices(half_width_matrices, len(TOPOLOGIES)), np.array(right_topology_indices, dtype=int)
+
+
+def run_metrics_on_block_files_in_pool(block_files, pool, processes, shard_min_nodes, batch_size, backend=None,
+                                       verify_fraction=0, trace_directory=None):
+    """
+    Scores block files in a pool, small graphs are scored by the pool workers and big ones here,
+    by shards scored by the same workers
+    :param block_files: list of (block file path, correct tree file path)
+    :param pool: multiprocessing.Pool
+    :param processes: number of processes of the pool
+    :param shard_min_nodes: graphs with fewer nodes are scored without sharding
+    :param batch_size: number of files handed to the pool at once, so that a consumer stopping early
+    does not leave the whole folder scored
+    :return: generator of results of run_metrics_on_block_file, in the order of the files
+    """
+    metrics_runner = partial(run_sharded_metrics, pool=pool, shard_min_nodes=shard_min_nodes,
+                             shard_number=SHARDS_PER_PROCESS * processes)
+    # Workers cannot use the pool, so they leave big graphs to this process, which parses them instead
+    score_small_file = partial(run_metrics_on_block_file, backend=backend, verify_fraction=verify_fraction,
+                               trace_directory=trace_directory, max_nodes=shard_min_nodes)
+    for start in range(0, len(block_files), batch_size):
+        batch = block_files[start:start + batch_size]
+        for (full_name, full_correct_tree_file_name), run_result in zip(batch, pool.starmap(score_small_file, batch)):
+            if run_result is None:
+                run_result = run_metrics_on_block_file(full_name, full_correct_tree_file_name, backend,
+                                                       verify_fraction, trace_directory, metrics_runner)
+            yield run_result
+
+
+def run_adaptive_computation_on_folder(block_folder_path, ci_width=None, backend=None, verify_fraction=0,
+                                       trace_directory=None, shard_pool=None, shard_processes=None,
+                                       shard_min_nodes=DEFAULT_SHARD_MIN_NODES):
+    """
+    Scores the files of a folder, with ci_width scoring them in random order
+    and stopping once the accuracy of every metric is known well enough, raises FileNotFoundError
+    if the folder has no block files
+    :param shard_pool: multiprocessing.Pool of shard_processes processes, if given, files are scored by it
+    and big graphs are scored by shards
+    :return: (numpy array of scores, scored files x metrics x topologies, numpy array of their confidence
+    half-widths, numpy array of right topology indices of the scored files, number of files in the folder)
+    """
+    block_files = list(list_block_files(block_folder_path))
+    if not block_files:
+        raise FileNotFoundError('Has not found {0} files in {1}'.format(BLOCK_FILE_NAME, block_folder_path))
+    if ci_width is not None:
+        shuffle(block_files)
+    if shard_pool is None:
+        run_results = (run_metrics_on_block_file(full_name, full_correct_tree_file_name, backend, verify_fraction,
+                                                 trace_directory)
+                       for full_name, full_correct_tree_file_name in block_files)
+    else:
+        # Without early stopping the whole folder goes to the pool at once
+        batch_size = max(len(block_files), 1) if ci_width is None else shard_processes
+        run_results = run_metrics_on_block_files_in_pool(block_files, shard_pool, shard_processes, shard_min_nodes,
+                                                         batch_size, backend, verify_fraction, trace_directory)
+    score_array, half_width_array, right_topology_indices = reduce_run_results(run_results, ci_width)
+    return score_array, half_width_array, right_topology_indices, len(block_files)
+
+
+def run_computation_on_folder(block_folder_path, backend=None, verify_fraction=0, trace_directory=None):
+    score_array, _, right_topology_indices, _ = run_adaptive_computation_on_folder(block_folder_path, None, backend,
+                                                                                   verify_fraction, trace_directory)
+    return get_accuracies(score_array, right_topology_indices).tolist()
+
+
+def save_scores(scores_path, folders, folder_results):
+    """
+    Saves scores of all files into a .npz archive: metric annotations, topologies, and for every folder
+    its files x metrics x topologies scores, their confidence half-widths and right topology indices
+    """
+    arrays = {'metrics': np.array(METRICS.metric_annotations()),
+              'topologies': np.array([str(topology) for topology in TOPOLOGIES])}
+    for folder, (score_array, half_width_array, right_topology_indices, _) in zip(folders, folder_results):
+        arrays['{0}_scores'.format(folder)] = score_array
+        arrays['{0}_half_widths'.format(folder)] = half_width_array
+        arrays['{0}_right'.format(folder)] = right_topology_indices
+    np.savez_compressed(scores_path, **arrays)
 
 
 def setup_logging():
@@ -75,42 +251,102 @@ def setup_logging():
     root.setLevel(log.DEBUG)
     handler = log.FileHandler(path.abspath('out.log'))
     root.addHandler(handler)
+    error_handler = log.StreamHandler(sys.stderr)
+    error_handler.setLevel(log.ERROR)
+    root.addHandler(error_handler)
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Compares accuracy of the metrics on folders of block files')
+    parser.add_argument('input_folder', help='folder or dataset pack containing run_e1_e2 folders')
+    parser.add_argument('folder_prefix', nargs='?', default=None,
+                        help='only folders starting with this prefix are processed')
+    parser.add_argument('--backend', choices=METRICS.backends(), default=METRICS.backend(),
+                        help='implementation of the metrics to run')
+    parser.add_argument('--verify-fraction', type=float, default=0,
+                        help='fraction of files, chosen randomly, to be re-scored on the reference backend')
+    parser.add_argument('--trace', default=None,
+                        help='path to write a Chrome trace of per file timings to')
+    parser.add_argument('--trace-top', type=int, default=DEFAULT_TOP_FILES,
+                        help='number of the slowest files to list after tracing')
+    parser.add_argument('--ci-width', type=float, default=None,
+                        help='score files in random order and stop a folder once the 95%% confidence interval '
+                             'of the accuracy of every metric is narrower than this')
+    parser.add_argument('--shard-processes', type=int, default=None,
+                        help='score folders one by one, their files over this many processes, splitting every '
+                             'big graph by connected components over the same processes')
+    parser.add_argument('--shard-min-nodes', type=int, default=DEFAULT_SHARD_MIN_NODES,
+                        help='graphs with fewer nodes are scored without sharding')
+    parser.add_argument('--scores', default=None,
+                        help='save scores of every file and, for the sampled backend, their confidence '
+                             'half-widths into this .npz archive')
+    arguments = parser.parse_args()
+    if arguments.shard_processes is not None and arguments.backend == REFERENCE_BACKEND:
+        parser.error('sharding needs a backend other than {0}'.format(REFERENCE_BACKEND))
+    return arguments
 
 
 def main():
-    if len(argv) < 2:
-        print('No block folder supplied')
-        exit(1)
-    input_folder = path.abspath(argv[1])
-    if not path.exists(input_folder):
+    arguments = parse_arguments()
+    input_folder = path.abspath(arguments.input_folder)
+    if not dataset_exists(input_folder):
         print("Path {0} doesn't exist".format(input_folder))
         exit(1)
 
-    if not path.isdir(input_folder):
+    if not is_dataset_directory(input_folder):
         print("Path {0} is not a directory path".format(input_folder))
         exit(1)
 
     folder_filterer = lambda _: True
 
-    if len(argv) == 3:
-        folder_filterer = lambda folder: folder.startswith(argv[2])
-
-    folder_header = ('run', 'e1', 'e2')
+    if arguments.folder_prefix is not None:
+        folder_filterer = lambda folder: folder.startswith(arguments.folder_prefix)
 
     setup_logging()
     max_width = max(map(len, METRICS.metric_annotations()))
 
-    with StdOutPrinter() as printer:
-        printer.write_header(chain(folder_header, METRICS.metric_annotations()), max_width)
-        folders_to_work_on = [f for f in listdir(input_folder) if
-                              folder_filterer(f) and path.isdir(path.join(input_folder, f))]
-        parallel_pool = mp.Pool()
-        folder_results = parallel_pool.map(run_computation_on_folder,
-                                           [path.join(input_folder, f) for f in folders_to_work_on])
-        for folder, folder_result in zip(folders_to_work_on, folder_results):
-            printer.write_row(folder.split('_'), folder_result, max_width)
+    with StdOutPrinter() as printer, TemporaryDirectory() as trace_parts_directory:
+        trace_directory = trace_parts_directory if arguments.trace is not None else None
+        printer.write_header(chain(FOLDER_HEADER, METRICS.metric_annotations()), max_width)
+        folders_to_work_on = [f for f in list_dataset_directory(input_folder) if
+                              folder_filterer(f) and is_dataset_directory(path.join(input_folder, f))]
+        folder_paths = [path.join(input_folder, f) for f in folders_to_work_on]
+        computation = partial(run_adaptive_computation_on_folder,
+                              ci_width=arguments.ci_width,
+                              backend=arguments.backend,
+                              verify_fraction=arguments.verify_fraction,
+                              trace_directory=trace_directory)
+        if arguments.shard_processes is not None:
+            # Pool workers cannot have pools of their own, so folders go one by one and share the pool for their
+            # files and for the shards of the big graphs
+            with mp.Pool(arguments.shard_processes) as shard_pool:
+                folder_results = [computation(folder_path, shard_pool=shard_pool,
+                                              shard_processes=arguments.shard_processes,
+                                              shard_min_nodes=arguments.shard_min_nodes)
+                                  for folder_path in folder_paths]
+        else:
+            parallel_pool = mp.Pool()
+            folder_results = parallel_pool.map(computation, folder_paths)
+        for folder, (score_array, _, right_topology_indices, _) in zip(folders_to_work_on, folder_results):
+            printer.write_row(folder.split('_'), get_accuracies(score_array, right_topology_indices).tolist(),
+                              max_width)
             # log.info('Finished directory {0}'.format(folder))
 
+        if arguments.ci_width is not None:
+            used_files = sum(len(score_array) for score_array, _, _, _ in folder_results)
+            all_files = sum(folder_file_count for _, _, _, folder_file_count in folder_results)
+            for folder, (score_array, _, _, folder_file_count) in zip(folders_to_work_on, folder_results):
+                print('{0}: scored {1} of {2} files'.format(folder, len(score_array), folder_file_count),
+                      file=sys.stderr)
+            print('Scored {0} of {1} files'.format(used_files, all_files), file=sys.stderr)
+
+        if arguments.scores is not None:
+            save_scores(arguments.scores, folders_to_work_on, folder_results)
+
+        if trace_directory is not None:
+            for line in merge_traces(trace_directory, path.abspath(arguments.trace), arguments.trace_top):
+                print(line, file=sys.stderr)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,343 @@
+__author__ = 'nikita_kartashov'
+
+from sys import argv
+from os import path, makedirs, walk
+from time import perf_counter
+from tempfile import TemporaryDirectory
+from threading import Thread, Event
+from queue import Queue, Full
+import io
+import gzip
+import lzma
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Dataset files may be stored compressed, e.g. blocks.txt.gz next to correct_tree.newick. They are
+# decompressed by a background thread a few chunks ahead of the reader, decompressors release the GIL,
+# so decompression overlaps with parsing.
+
+GZIP_EXTENSION = '.gz'
+XZ_EXTENSION = '.xz'
+ZSTD_EXTENSION = '.zst'
+COMPRESSED_EXTENSIONS = (GZIP_EXTENSION, XZ_EXTENSION, ZSTD_EXTENSION)
+DECOMPRESSED_CHUNK_SIZE = 1 << 20
+READ_AHEAD_CHUNKS = 4
+# How often a blocked decompression thread checks whether the reader is closed, in seconds
+STOP_CHECK_INTERVAL = 0.1
+
+
+def get_compression_extension(file_path):
+    """
+    :return: extension of the compression the file is stored with or None for uncompressed files
+    """
+    _, extension = path.splitext(file_path)
+    return extension if extension in COMPRESSED_EXTENSIONS else None
+
+
+def get_stored_names(file_name):
+    """
+    :return: names the file may be stored under, the uncompressed one goes first
+    """
+    return (file_name,) + tuple(file_name + extension for extension in COMPRESSED_EXTENSIONS)
+
+
+def find_stored_name(file_name, file_names):
+    """
+    Looks for the file among directory contents, preferring the uncompressed one
+    :param file_name: uncompressed name, e.g. blocks.txt
+    :param file_names: names of files in the directory
+    :return: name the file is stored under or None
+    """
+    file_names = set(file_names)
+    return next((name for name in get_stored_names(file_name) if name in file_names), None)
+
+
+class ZstdReader(io.RawIOBase):
+    def __init__(self, binary_file, chunk_size=DECOMPRESSED_CHUNK_SIZE):
+        """
+        Decompresses zstd frames one after another, unlike zstandard stream readers it raises EOFError
+        on a truncated file, as gzip and lzma files do
+        :param binary_file: compressed contents
+        :param chunk_size: size of the compressed chunks read at once
+        :return: the resulting object
+        """
+        super().__init__()
+        self._file = binary_file
+        self._chunk_size = chunk_size
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self._frame_started = False
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def _decompress(self, data):
+        self._frame_started = True
+        decompressed = self._decompressor.decompress(data)
+        if self._decompressor.eof:
+            unused_data = self._decompressor.unused_data
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+            self._frame_started = False
+            if unused_data:
+                decompressed += self._decompress(unused_data)
+        return decompressed
+
+    def readinto(self, buffer):
+        while not self._pending:
+            data = self._file.read(self._chunk_size)
+            if not data:
+                if self._frame_started:
+                    raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+                return 0
+            self._pending = memoryview(self._decompress(data))
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def get_decompressing_reader(binary_file, extension):
+    if extension == GZIP_EXTENSION:
+        return gzip.GzipFile(fileobj=binary_file)
+    if extension == XZ_EXTENSION:
+        return lzma.LZMAFile(binary_file)
+    if extension == ZSTD_EXTENSION:
+        if zstandard is None:
+            raise ImportError('Reading {0} files needs the zstandard package'.format(ZSTD_EXTENSION))
+        return ZstdReader(binary_file)
+    raise ValueError('Unknown compression {0}'.format(extension))
+
+
+def compress(data, extension):
+    if extension == GZIP_EXTENSION:
+        return gzip.compress(data)
+    if extension == XZ_EXTENSION:
+        return lzma.compress(data)
+    if extension == ZSTD_EXTENSION:
+        if zstandard is None:
+            raise ImportError('Writing {0} files needs the zstandard package'.format(ZSTD_EXTENSION))
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError('Unknown compression {0}'.format(extension))
+
+
+def available_extensions():
+    return tuple(extension for extension in COMPRESSED_EXTENSIONS
+                 if extension != ZSTD_EXTENSION or zstandard is not None)
+
+
+class ReadAheadReader(io.RawIOBase):
+    def __init__(self, reader, closed_with=(), chunk_size=DECOMPRESSED_CHUNK_SIZE, read_ahead=READ_AHEAD_CHUNKS):
+        """
+        Reads a binary stream in a background thread, keeping up to read_ahead chunks ready
+        :param reader: binary file-like object, e.g. a decompressing one
+        :param closed_with: file-like objects closed along with the reader, e.g. the compressed file
+        :param chunk_size: size of the chunks read in the background
+        :param read_ahead: maximal number of chunks read but not consumed yet
+        :return: the resulting object
+        """
+        super().__init__()
+        self._reader = reader
+        self._closed_with = tuple(closed_with)
+        self._chunk_size = chunk_size
+        self._chunks = Queue(read_ahead)
+        self._stopped = Event()
+        self._pending = memoryview(b'')
+        self._finished = False
+        self._thread = Thread(target=self._read_chunks, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=STOP_CHECK_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read_chunks(self):
+        try:
+            while True:
+                chunk = self._reader.read(self._chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as error:
+            self._put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._pending:
+            if self._finished:
+                return 0
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception):
+                self._finished = True
+                raise chunk
+            if not chunk:
+                self._finished = True
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            self._thread.join()
+            self._reader.close()
+            for closed_file in self._closed_with:
+                closed_file.close()
+        super().close()
+
+
+def open_compressed(binary_file, extension, read_ahead=True):
+    """
+    Opens a compressed file for reading text
+    :param binary_file: compressed contents, owned by the result from now on
+    :param extension: compression extension, one of COMPRESSED_EXTENSIONS
+    :param read_ahead: decompress in a background thread
+    :return: text file-like object
+    """
+    reader = get_decompressing_reader(binary_file, extension)
+    if read_ahead:
+        reader = ReadAheadReader(reader, (binary_file,))
+    return io.TextIOWrapper(io.BufferedReader(reader, DECOMPRESSED_CHUNK_SIZE))
+
+
+def open_stored_file(file_path):
+    """
+    Opens a file for reading text, decompressing it if its extension says it is compressed
+    """
+    extension = get_compression_extension(file_path)
+    if extension is None:
+        return open(file_path)
+    return open_compressed(open(file_path, 'rb'), extension)
+
+
+def compress_dataset(root_directory, output_directory, extension, file_names=('blocks.txt',)):
+    """
+    Copies a dataset directory, compressing the given files
+    :param root_directory: dataset root, e.g. folder containing run_e1_e2 folders
+    :param output_directory: root of the copy
+    :param extension: compression extension, one of COMPRESSED_EXTENSIONS
+    :param file_names: names of the files to compress, other files are copied as is
+    :return: (total size of the compressed files before, after)
+    """
+    root_directory = path.abspath(root_directory)
+    original_size = compressed_size = 0
+    for root, _, files in walk(root_directory):
+        output_root = path.join(output_directory, path.relpath(root, root_directory))
+        makedirs(output_root, exist_ok=True)
+        for f in files:
+            if f not in file_names:
+                shutil.copyfile(path.join(root, f), path.join(output_root, f))
+                continue
+            with open(path.join(root, f), 'rb') as original_file:
+                data = original_file.read()
+            compressed_data = compress(data, extension)
+            with open(path.join(output_root, f + extension), 'wb') as output_file:
+                output_file.write(compressed_data)
+            original_size += len(data)
+            compressed_size += len(compressed_data)
+    return original_size, compressed_size
+
+
+def report_compression(root_directory, file_name='blocks.txt'):
+    """
+    Compresses the given files of a dataset with every available compression and prints their disk footprint,
+    time to read them and to parse them into breakpoint graphs, compared to the uncompressed files
+    """
+    from bg.bg_io import GRIMMReader
+
+    root_directory = path.abspath(root_directory)
+    file_paths = [path.join(root, f) for root, _, files in walk(root_directory) for f in files
+                  if f in get_stored_names(file_name)]
+    if not file_paths:
+        print('No {0} files under {1}'.format(file_name, root_directory))
+        return
+
+    def time_reading(stored_paths, consume):
+        start = perf_counter()
+        for stored_path in stored_paths:
+            with open_stored_file(stored_path) as stored_file:
+                consume(stored_file)
+        return perf_counter() - start
+
+    def read_all(stored_file):
+        while stored_file.read(DECOMPRESSED_CHUNK_SIZE):
+            pass
+
+    with TemporaryDirectory() as working_directory:
+        plain_paths = []
+        for i, file_path in enumerate(file_paths):
+            plain_path = path.join(working_directory, '{0}_{1}'.format(i, file_name))
+            with open_stored_file(file_path) as source_file, open(plain_path, 'w') as plain_file:
+                shutil.copyfileobj(source_file, plain_file)
+            plain_paths.append(plain_path)
+        plain_size = sum(path.getsize(plain_path) for plain_path in plain_paths)
+        megabytes = plain_size / float(1 << 20)
+
+        print('{0} files, {1:.2f}MB uncompressed'.format(len(plain_paths), megabytes))
+        print('format\tdisk MB\tratio\tread s\tread MB/s\tparse s\tparse MB/s')
+        for extension in (None,) + available_extensions():
+            stored_paths = plain_paths
+            if extension is not None:
+                stored_paths = [plain_path + extension for plain_path in plain_paths]
+                for plain_path, stored_path in zip(plain_paths, stored_paths):
+                    with open(plain_path, 'rb') as plain_file, open(stored_path, 'wb') as stored_file:
+                        stored_file.write(compress(plain_file.read(), extension))
+            stored_size = sum(path.getsize(stored_path) for stored_path in stored_paths)
+            read_time = time_reading(stored_paths, read_all)
+            parse_time = time_reading(stored_paths, GRIMMReader.get_breakpoint_graph)
+            print('{0}\t{1:.2f}\t{2:.2f}\t{3:.3f}\t{4:.1f}\t{5:.3f}\t{6:.1f}'.format(
+                extension or 'plain', stored_size / float(1 << 20), plain_size / float(stored_size),
+                read_time, megabytes / read_time, parse_time, megabytes / parse_time))
+
+
+def check_compressions():
+    """
+    Reads data back in every available compression, whole, as concatenated streams and truncated,
+    a truncated file must raise EOFError rather than read as a shorter one
+    """
+    text = ''.join('{0} {1} -{2} $\n'.format(i, i + 1, i + 2) for i in range(100000))
+    data = text.encode()
+
+    def read(compressed, extension, read_ahead):
+        with open_compressed(io.BytesIO(compressed), extension, read_ahead) as compressed_file:
+            return compressed_file.read()
+
+    for extension in available_extensions():
+        compressed = compress(data, extension)
+        for read_ahead in (False, True):
+            assert (read(compressed, extension, read_ahead) == text)
+            assert (read(compressed + compressed, extension, read_ahead) == text + text)
+            try:
+                read(compressed[:len(compressed) // 2], extension, read_ahead)
+                assert False, 'Truncated {0} file has been read'.format(extension)
+            except EOFError:
+                pass
+        print('{0}: ok'.format(extension))
+
+
+if __name__ == '__main__':
+    if len(argv) == 2 and argv[1] == 'check':
+        check_compressions()
+    elif len(argv) == 3 and argv[1] == 'report':
+        report_compression(argv[2])
+    elif len(argv) == 5 and argv[1] == 'compress':
+        before, after = compress_dataset(argv[2], argv[3], argv[4])
+        print('Compressed {0} bytes into {1}'.format(before, after))
+    else:
+        print('Usage: python -m src.compression check\n'
+              '       python -m src.compression report <dataset root>\n'
+              '       python -m src.compression compress <dataset root> <output root> <{0}>'.format(
+                  '|'.join(COMPRESSED_EXTENSIONS)))
+        exit(1)
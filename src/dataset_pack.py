@@ -0,0 +1,221 @@
+__author__ = 'nikita_kartashov'
+
+from sys import argv
+from os import path, walk, listdir, sep
+from io import StringIO, BytesIO
+from collections import defaultdict
+import json
+import mmap
+import struct
+
+from .compression import get_compression_extension, open_compressed, open_stored_file
+
+# Pack layout: magic, offset and length of the index, then contents of all files back to back,
+# then the index itself, a JSON object from relative paths to (offset, length) of their contents.
+# Files inside a pack are addressed by virtual paths: path of the pack joined with the relative path,
+# e.g. /data/datasets.pack/1_10_5/0/blocks.txt
+PACK_MAGIC = b'4GPACK01'
+PACK_HEADER = struct.Struct('<8sQQ')
+
+
+def build_pack(root_directory, pack_path):
+    """
+    Bundles all files under the directory into a single pack file
+    :param root_directory: dataset root, e.g. folder containing run_e1_e2 folders
+    :param pack_path: path of the resulting pack
+    :return: number of packed files
+    """
+    root_directory = path.abspath(root_directory)
+    relative_paths = sorted(path.relpath(path.join(root, f), root_directory)
+                            for root, dirs, files in walk(root_directory) for f in files)
+    index = {}
+    with open(pack_path, 'wb') as pack_file:
+        pack_file.write(PACK_HEADER.pack(PACK_MAGIC, 0, 0))
+        for relative_path in relative_paths:
+            with open(path.join(root_directory, relative_path), 'rb') as packed_file:
+                contents = packed_file.read()
+            index[relative_path.replace(sep, '/')] = (pack_file.tell(), len(contents))
+            pack_file.write(contents)
+        index_offset = pack_file.tell()
+        encoded_index = json.dumps(index).encode()
+        pack_file.write(encoded_index)
+        pack_file.seek(0)
+        pack_file.write(PACK_HEADER.pack(PACK_MAGIC, index_offset, len(encoded_index)))
+    return len(index)
+
+
+def is_pack(pack_path):
+    if not path.isfile(pack_path):
+        return False
+    with open(pack_path, 'rb') as pack_file:
+        return pack_file.read(len(PACK_MAGIC)) == PACK_MAGIC
+
+
+class DatasetPack(object):
+    def __init__(self, pack_path):
+        """
+        Opens a pack for random access to its files through a memory map
+        :param pack_path: path of the pack file
+        :return: the resulting object
+        """
+        self._pack_path = pack_path
+        with open(pack_path, 'rb') as pack_file:
+            self._map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = PACK_HEADER.unpack_from(self._map)
+        if magic != PACK_MAGIC:
+            raise ValueError('{0} is not a dataset pack'.format(pack_path))
+        self._index = json.loads(self._map[index_offset:index_offset + index_length].decode())
+        self._directories = defaultdict(lambda: (set(), []))
+        for relative_path in sorted(self._index):
+            parts = relative_path.split('/')
+            for depth in range(len(parts) - 1):
+                self._directories['/'.join(parts[:depth])][0].add(parts[depth])
+            self._directories['/'.join(parts[:-1])][1].append(parts[-1])
+
+    def read(self, relative_path):
+        try:
+            offset, length = self._index[relative_path]
+        except KeyError:
+            raise FileNotFoundError('No file {0} in pack {1}'.format(relative_path, self._pack_path))
+        return self._map[offset:offset + length]
+
+    def open(self, relative_path):
+        extension = get_compression_extension(relative_path)
+        if extension is not None:
+            # Packed files are in memory already, so there is nothing to read ahead
+            return open_compressed(BytesIO(self.read(relative_path)), extension, read_ahead=False)
+        return StringIO(self.read(relative_path).decode())
+
+    def is_directory(self, relative_path):
+        return relative_path in self._directories
+
+    def exists(self, relative_path):
+        return relative_path in self._index or self.is_directory(relative_path)
+
+    def listdir(self, relative_path=''):
+        directories, files = self._directories[relative_path] if self.is_directory(relative_path) else ((), ())
+        return sorted(directories) + list(files)
+
+    def walk(self, top=''):
+        """
+        Walks the pack top-down the way os.walk walks directories
+        :param top: relative path of the directory to start from, the whole pack by default
+        :return: generator of (relative directory path, directory names, file names)
+        """
+        if not self.is_directory(top):
+            return
+        directories, files = self._directories[top]
+        directories = sorted(directories)
+        yield top, directories, list(files)
+        for directory in directories:
+            yield from self.walk('{0}/{1}'.format(top, directory) if top else directory)
+
+
+_open_packs = {}
+
+
+def get_pack(pack_path):
+    """
+    Returns an opened pack, every process opens and maps each pack only once
+    """
+    if pack_path not in _open_packs:
+        _open_packs[pack_path] = DatasetPack(pack_path)
+    return _open_packs[pack_path]
+
+
+def find_open_pack(dataset_path):
+    """
+    Looks for an already opened pack containing the path, without touching the filesystem
+    :param dataset_path: absolute path
+    :return: (pack path, relative path inside the pack) or (None, dataset_path)
+    """
+    for pack_path in _open_packs:
+        if dataset_path == pack_path:
+            return pack_path, ''
+        if dataset_path.startswith(pack_path + sep):
+            return pack_path, dataset_path[len(pack_path) + 1:].replace(sep, '/')
+    return None, dataset_path
+
+
+def split_pack_path(dataset_path):
+    """
+    Splits a virtual path into the pack and the path inside of it
+    :param dataset_path: path to a file or a directory, possibly inside a pack
+    :return: (pack path, relative path inside the pack) or (None, dataset_path) for plain paths
+    """
+    dataset_path = path.abspath(dataset_path)
+    pack_path, relative_path = find_open_pack(dataset_path)
+    if pack_path is not None:
+        return pack_path, relative_path
+
+    prefix, inner_parts = dataset_path, []
+    while not path.exists(prefix):
+        parent, part = path.split(prefix)
+        if parent == prefix:
+            return None, dataset_path
+        prefix = parent
+        inner_parts.append(part)
+    if is_pack(prefix):
+        return prefix, '/'.join(reversed(inner_parts))
+    return None, dataset_path
+
+
+def is_dataset_directory(dataset_path):
+    pack_path, relative_path = split_pack_path(dataset_path)
+    if pack_path is None:
+        return path.isdir(dataset_path)
+    return get_pack(pack_path).is_directory(relative_path)
+
+
+def dataset_exists(dataset_path):
+    pack_path, relative_path = split_pack_path(dataset_path)
+    if pack_path is None:
+        return path.exists(dataset_path)
+    return get_pack(pack_path).exists(relative_path)
+
+
+def list_dataset_directory(dataset_path):
+    pack_path, relative_path = split_pack_path(dataset_path)
+    if pack_path is None:
+        return listdir(dataset_path)
+    return get_pack(pack_path).listdir(relative_path)
+
+
+def walk_dataset(top, directory_walk=walk):
+    """
+    Walks a directory or a directory inside a pack, yielding virtual paths for the latter
+    :param top: directory to walk
+    :param directory_walk: walk used for plain directories, os.walk by default
+    :return: generator of (directory path, directory names, file names)
+    """
+    pack_path, relative_path = split_pack_path(top)
+    if pack_path is None:
+        yield from directory_walk(top)
+        return
+    for root, directories, files in get_pack(pack_path).walk(relative_path):
+        yield path.join(pack_path, *root.split('/')) if root else pack_path, directories, files
+
+
+def open_dataset_file(dataset_path):
+    """
+    Opens a file for reading text, the file may reside inside a pack and may be compressed
+    :param dataset_path: plain or virtual path
+    :return: file-like object
+    """
+    pack_path, relative_path = find_open_pack(path.abspath(dataset_path))
+    if pack_path is None:
+        # Plain files are opened right away, so that unpacked datasets do not pay for pack detection
+        if path.isfile(dataset_path):
+            return open_stored_file(dataset_path)
+        pack_path, relative_path = split_pack_path(dataset_path)
+        if pack_path is None:
+            return open_stored_file(dataset_path)
+    return get_pack(pack_path).open(relative_path)
+
+
+if __name__ == '__main__':
+    if len(argv) != 3:
+        print('Usage: python -m src.dataset_pack <dataset root> <pack path>')
+        exit(1)
+
+    print('Packed {0} files'.format(build_pack(argv[1], argv[2])))
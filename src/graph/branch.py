@@ -9,6 +9,53 @@ def compute_tree_score_with_branches(branches, tree):
     return sum(score for branch, score in branches if not does_intersect(branch, tree))
 
 
+def get_tree_leaves(tree):
+    """
+    Returns leaves of a tree in the form of nested tuples, e.g. ((('A', 'E'), 'B'), ('C', 'D'))
+    :param tree: leaf name or tuple of subtrees
+    :return: frozenset of leaf names
+    """
+    if not isinstance(tree, tuple):
+        return frozenset([tree])
+    return frozenset().union(*map(get_tree_leaves, tree))
+
+
+def get_tree_splits(tree):
+    """
+    Returns all splits of an unrooted tree given as nested tuples, every split is stored as both of its sides
+    :param tree: tree in the form of nested tuples, e.g. ((('A', 'E'), 'B'), ('C', 'D'))
+    :return: frozenset of sides, each of which is a frozenset of leaves
+    """
+    all_leaves = get_tree_leaves(tree)
+    splits = set()
+
+    def collect(subtree):
+        leaves = get_tree_leaves(subtree)
+        splits.update((leaves, all_leaves - leaves))
+        if isinstance(subtree, tuple):
+            for child in subtree:
+                collect(child)
+
+    collect(tree)
+    return frozenset(splits)
+
+
+def is_branch_trivial(branch):
+    return min(map(len, branch)) <= 1
+
+
+def compute_tree_score_with_splits(branches, tree):
+    """
+    Generalisation of compute_tree_score_with_branches to trees with any number of leaves
+    :param branches: iterable of (split, score), split being a pair of leaf sets
+    :param tree: tree in the form of nested tuples
+    :return: sum of the scores of trivial splits and splits present in the tree
+    """
+    tree_splits = get_tree_splits(tree)
+    return sum(score for branch, score in branches
+               if is_branch_trivial(branch) or frozenset(branch[0]) in tree_splits)
+
+
 if __name__ == '__main__':
     def intersect_test():
         branch1 = (frozenset(), frozenset(['A', 'B', 'C', 'D']))
@@ -23,4 +70,19 @@ if __name__ == '__main__':
         assert (does_intersect(branch3, tree1))
         assert (not does_intersect(branch3, tree2))
 
-    intersect_test()
\ No newline at end of file
+    def splits_test():
+        branches = ((frozenset(), frozenset(['A', 'B', 'C', 'D'])),
+                    (frozenset(['A']), frozenset(['B', 'C', 'D'])),
+                    (frozenset(['A', 'B']), frozenset(['C', 'D'])),
+                    (frozenset(['A', 'C']), frozenset(['B', 'D'])))
+        scored_branches = tuple(zip(branches, (1, 2, 4, 8)))
+        for tree in ((('A', 'B'), ('C', 'D')), (('A', 'C'), ('B', 'D')), (('A', 'D'), ('C', 'B'))):
+            assert (compute_tree_score_with_splits(scored_branches, tree) ==
+                    compute_tree_score_with_branches(scored_branches, tree))
+        five_leaf_tree = ((('A', 'E'), 'B'), ('C', 'D'))
+        assert (frozenset(['A', 'E']) in get_tree_splits(five_leaf_tree))
+        assert (frozenset(['A', 'B', 'E']) in get_tree_splits(five_leaf_tree))
+        assert (frozenset(['A', 'B']) not in get_tree_splits(five_leaf_tree))
+
+    intersect_test()
+    splits_test()
\ No newline at end of file
@@ -0,0 +1,399 @@
+__author__ = 'nikita_kartashov'
+
+from collections import Counter, defaultdict
+from math import ceil
+
+from src.graph import statistics
+from src.graph import fast_statistics
+from src.graph.branch import compute_tree_score_with_branches
+from src.graph.breakpoint_graph_extensions import multicolor_to_normalized_split
+from src.graph.fast_statistics import get_adjacency_graph, colors_key, ACCELERATED_METRICS
+from src.graph.statistics import sum_metric_batches, ALL_GENOMES, NEGATIVE
+
+# Optional preprocessing for the accelerated metrics: maximal chains of simple vertices (multidegree 2)
+# are contracted into super-edges between the other vertices, keeping the multicolors of the chain edges
+# and the positions of the chain vertices in the node order.
+#
+# Alternating traversals need no more than that. Edges of two given multicolors form disjoint alternating
+# paths and cycles, and the reference traversal enters every such component at its first node in the node
+# order, so its two half traversals depend only on the length of the component and the position of that
+# node. Components are thus assembled from super-edges instead of being walked edge by edge. If the graph
+# breaks the assumptions (self-loops, parallel edges, a vertex with two edges of the same multicolor),
+# the metrics fall back to the uncontracted index.
+#
+# Patterns are 4-cycles, so interiors of longer chains are dropped before searching for them.
+
+SIMPLE_VERTEX_MULTIDEGREE = 2
+# Chains with at least this many edges cannot lie on a 4-cycle
+PATTERN_FREE_CHAIN_LENGTH = 4
+# The same for chains returning to their start vertex and for cycles made of simple vertices only
+PATTERN_FREE_LOOP_LENGTH = 5
+NO_RANK = float('inf')
+
+
+def path_half_lengths(length, start_position, first_is_color1):
+    """
+    Returns lengths of the two traversals of an alternating path started from the given node
+    :param length: number of edges of the path
+    :param start_position: position of the start node counted from the beginning of the path
+    :param first_is_color1: whether the first edge of the path has the first multicolor
+    :return: (length traversed starting in the first multicolor, length traversed starting in the second)
+    """
+    if start_position < length:
+        forward_is_color1 = first_is_color1 == (start_position % 2 == 0)
+    else:
+        forward_is_color1 = first_is_color1 != ((length - 1) % 2 == 0)
+    if forward_is_color1:
+        return length - start_position, start_position
+    return start_position, length - start_position
+
+
+def reverse_segment(length, first_is_color1, min_rank, min_offset):
+    return length, first_is_color1 == (length % 2 == 1), min_rank, None if min_offset is None else length - min_offset
+
+
+class ContractedGraph(object):
+    def __init__(self, graph):
+        """
+        Contracts maximal chains of simple vertices of an indexed BP graph
+        :param graph: AdjacencyGraph
+        :return: the resulting object
+        """
+        self.rank = dict((node, i) for i, node in enumerate(graph.nodes))
+        self.exact = all(len(set(neighbour for neighbour, _, _ in graph.neighbours[node]) - {node}) ==
+                         graph.multidegree(node) for node in graph.nodes)
+        # (start vertex, end vertex, multicolor keys of the edges, colors of the edges, inner simple vertices),
+        # start and end are None for cycles made of simple vertices only, edges between two vertices are chains too
+        self.chains = []
+        self._cache = {}
+        if not self.exact:
+            self.vertices = graph.nodes
+            return
+
+        simple = frozenset(node for node in graph.nodes if graph.multidegree(node) == SIMPLE_VERTEX_MULTIDEGREE)
+        # Vertices of the contracted graph
+        self.vertices = tuple(node for node in graph.nodes if node not in simple)
+        contracted = set()
+
+        def follow_chain(previous, current, keys, colors):
+            inner = []
+            while current in simple and current not in contracted:
+                contracted.add(current)
+                inner.append(current)
+                previous, (current, key, edge_colors) = current, next(edge for edge in graph.neighbours[current]
+                                                                      if edge[0] != previous)
+                keys.append(key)
+                colors.append(edge_colors)
+            return current, tuple(keys), tuple(colors), tuple(inner)
+
+        for vertex in self.vertices:
+            for neighbour, key, colors in graph.neighbours[vertex]:
+                if neighbour in contracted or (neighbour not in simple and self.rank[neighbour] < self.rank[vertex]):
+                    continue
+                self.chains.append((vertex,) + follow_chain(vertex, neighbour, [key], [colors]))
+        for node in graph.nodes:
+            if node in simple and node not in contracted:
+                self.chains.append((None, None) + follow_chain(None, node, [], [])[1:])
+
+    def size(self):
+        """
+        :return: (number of vertices, number of super-edges) of the contracted graph
+        """
+        return len(self.vertices), len(self.chains)
+
+    def pattern_free_nodes(self):
+        """
+        Returns inner vertices of the chains which are too long to be a part of any pattern
+        """
+        removed_nodes = set()
+        for start, end, keys, _, inner in self.chains:
+            if len(keys) >= (PATTERN_FREE_CHAIN_LENGTH if start is not None and start != end
+                             else PATTERN_FREE_LOOP_LENGTH):
+                removed_nodes.update(inner)
+        return removed_nodes
+
+    def half_lengths(self, color1, color2):
+        """
+        Counts lengths of the traversals the reference alternating traversal makes for two multicolors
+        :param color1: multicolor key of the first traversed color
+        :param color2: multicolor key of the second one
+        :return: Counter of traversal lengths, two per component, or None if the graph cannot be handled
+        """
+        if (color1, color2) not in self._cache:
+            self._cache[color1, color2] = self._count_half_lengths(color1, color2) if self.exact else None
+        return self._cache[color1, color2]
+
+    def _count_half_lengths(self, color1, color2):
+        pair = (color1, color2)
+        half_lengths = Counter()
+        # (start vertex, end vertex or None for a dead end, length, first_is_color1, min_rank, min_offset)
+        segments = []
+
+        def count_component(length, start_position, first_is_color1):
+            half_lengths.update(path_half_lengths(length, start_position, first_is_color1))
+
+        def inner_minimum(ranks, positions, offset):
+            return min(((ranks[t], offset(t)) for t in positions), default=(NO_RANK, None))
+
+        for start, end, keys, _, inner in self.chains:
+            ranks = [self.rank[node] for node in inner]
+            if start is None:
+                if all(key in pair for key in keys):
+                    if any(keys[t] == keys[t - 1] for t in range(len(keys))):
+                        return None
+                    half_lengths[len(keys) - 1] += 1
+                    half_lengths[0] += 1
+                    continue
+                # Cut the cycle at an edge of neither multicolor
+                cut = next(t for t, key in enumerate(keys) if key not in pair)
+                keys = keys[cut + 1:] + keys[:cut]
+                ranks = ranks[cut + 1:] + ranks[:cut + 1]
+            else:
+                ranks = [None] + ranks + [None]
+
+            edge_count = len(keys)
+            for t, rank in enumerate(ranks):
+                if rank is not None and (t == 0 or keys[t - 1] not in pair) and \
+                        (t == edge_count or keys[t] not in pair):
+                    half_lengths[0] += 2
+
+            t = 0
+            while t < edge_count:
+                if keys[t] not in pair:
+                    t += 1
+                    continue
+                run_start = t
+                t += 1
+                while t < edge_count and keys[t] in pair:
+                    if keys[t] == keys[t - 1]:
+                        return None
+                    t += 1
+                run_end = t
+                at_start, at_end = ranks[run_start] is None, ranks[run_end] is None
+                if not at_start and not at_end:
+                    start_position = min(range(run_start, run_end + 1), key=ranks.__getitem__) - run_start
+                    count_component(run_end - run_start, start_position, keys[run_start] == color1)
+                elif at_start and at_end:
+                    segments.append((start, end, edge_count, keys[0] == color1) +
+                                    inner_minimum(ranks, range(1, edge_count), lambda p: p))
+                elif at_start:
+                    segments.append((start, None, run_end, keys[0] == color1) +
+                                    inner_minimum(ranks, range(1, run_end + 1), lambda p: p))
+                else:
+                    segments.append((end, None, edge_count - run_start, keys[-1] == color1) +
+                                    inner_minimum(ranks, range(run_start, edge_count),
+                                                  lambda p: edge_count - p))
+
+        links = defaultdict(list)
+        for index, (start, end, _, _, _, _) in enumerate(segments):
+            links[start].append((index, True))
+            if end is not None:
+                links[end].append((index, False))
+
+        def oriented(link):
+            index, at_start = link
+            start, end, length, first_is_color1, min_rank, min_offset = segments[index]
+            if at_start:
+                return end, (length, first_is_color1, min_rank, min_offset)
+            return start, reverse_segment(length, first_is_color1, min_rank, min_offset)
+
+        for vertex, vertex_links in links.items():
+            if len(vertex_links) > 2 or \
+                    len(set(oriented(link)[1][1] for link in vertex_links)) != len(vertex_links):
+                return None
+
+        def walk(first_vertex, link):
+            """
+            :return: list of (vertex, oriented segment) from the first vertex on, the last vertex
+            or None for a dead end inside a chain, whether the walk returned to the first vertex
+            """
+            steps = []
+            vertex = first_vertex
+            while True:
+                far_vertex, segment = oriented(link)
+                steps.append((vertex, segment))
+                if far_vertex is None or far_vertex == first_vertex:
+                    return steps, far_vertex, far_vertex is not None
+                arrival = (link[0], not link[1])
+                next_links = [other for other in links[far_vertex] if other != arrival]
+                if not next_links:
+                    return steps, far_vertex, False
+                vertex, link = far_vertex, next_links[0]
+
+        visited = set()
+        for vertex in self.vertices:
+            if vertex in visited:
+                continue
+            visited.add(vertex)
+            if not links[vertex]:
+                half_lengths[0] += 2
+                continue
+
+            forward, forward_end, is_cycle = walk(vertex, links[vertex][0])
+            visited.update(step_vertex for step_vertex, _ in forward)
+            if is_cycle:
+                half_lengths[sum(segment[0] for _, segment in forward) - 1] += 1
+                half_lengths[0] += 1
+                continue
+
+            backward, backward_end = [], None
+            if len(links[vertex]) == 2:
+                backward, backward_end, _ = walk(vertex, links[vertex][1])
+                visited.update(step_vertex for step_vertex, _ in backward)
+            path = []
+            far_vertex = backward_end
+            for step_vertex, segment in reversed(backward):
+                path.append((far_vertex, reverse_segment(*segment)))
+                far_vertex = step_vertex
+            path.extend(forward)
+            visited.update(end_vertex for end_vertex in (forward_end, backward_end) if end_vertex is not None)
+
+            position = 0
+            start_node = (NO_RANK, None)
+            for step_vertex, (length, _, min_rank, min_offset) in path:
+                if step_vertex is not None:
+                    start_node = min(start_node, (self.rank[step_vertex], position))
+                if min_offset is not None:
+                    start_node = min(start_node, (min_rank, position + min_offset))
+                position += length
+            if forward_end is not None:
+                start_node = min(start_node, (self.rank[forward_end], position))
+            count_component(position, start_node[1], path[0][1][1])
+
+        return half_lengths
+
+
+def get_contracted_graph(breakpoint_graph):
+    graph = get_adjacency_graph(breakpoint_graph)
+    return graph.cached('contracted', lambda: ContractedGraph(graph))
+
+
+def get_pattern_core(breakpoint_graph):
+    """
+    Returns the index of the graph without the vertices which cannot be a part of any pattern
+    """
+    graph = get_adjacency_graph(breakpoint_graph)
+    return graph.cached('pattern_core', lambda: graph.without_nodes(get_contracted_graph(graph).pattern_free_nodes()))
+
+
+def get_simple_paths_metric(breakpoint_graph, tree_topology):
+    graph = get_adjacency_graph(breakpoint_graph)
+    contracted_graph = get_contracted_graph(graph)
+    if not contracted_graph.exact:
+        return fast_statistics.get_simple_paths_metric(graph, tree_topology)
+
+    def count_simple_splits():
+        # Edges between two simple vertices are exactly the edges inside the chains
+        result = defaultdict(lambda: 0)
+        for start, _, _, colors, _ in contracted_graph.chains:
+            for edge_colors in (colors if start is None else colors[1:-1]):
+                result[multicolor_to_normalized_split(edge_colors, ALL_GENOMES)] += 1
+        return tuple(result.items())
+
+    return NEGATIVE * compute_tree_score_with_branches(graph.cached('contracted_simple_paths', count_simple_splits),
+                                                       tree_topology)
+
+
+def get_size_of_alternating_structures(breakpoint_graph, colors, modifier=lambda x: x,
+                                       get_size_of_paths_instead_of_cycles=True):
+    graph = get_adjacency_graph(breakpoint_graph)
+    half_lengths = get_contracted_graph(graph).half_lengths(*map(colors_key, colors))
+    if half_lengths is None:
+        return fast_statistics.get_size_of_alternating_structures(graph, colors, modifier,
+                                                                  get_size_of_paths_instead_of_cycles)
+    resulting_length = 0
+    for half_length, count in half_lengths.items():
+        # As in the reference implementation every nonempty traversal gets its missing edge when
+        # counting cycles
+        if not get_size_of_paths_instead_of_cycles and half_length > 0:
+            half_length += 1
+        resulting_length += count * modifier(half_length)
+    return resulting_length
+
+
+def get_ca_metric(breakpoint_graph, tree_topology):
+    def halver(value):
+        return ceil(value * 1.0 / 2)
+
+    return NEGATIVE * get_size_of_alternating_structures(breakpoint_graph, tree_topology, halver)
+
+
+def get_mca_metric(breakpoint_graph, tree_topology):
+    def cycle_specific_halver(value):
+        return value / 2 - 1
+
+    ca_score = get_ca_metric(breakpoint_graph, tree_topology)
+    cycles_length = get_size_of_alternating_structures(breakpoint_graph, tree_topology, cycle_specific_halver,
+                                                       get_size_of_paths_instead_of_cycles=False)
+    return ca_score + NEGATIVE * cycles_length
+
+
+def get_mca_metric_batch(breakpoint_graph, topologies):
+    return ((get_mca_metric(breakpoint_graph, topology), topology) for topology in topologies)
+
+
+def get_cylinder_pattern_metric_batch(breakpoint_graph, topologies):
+    return fast_statistics.get_cylinder_pattern_metric_batch(get_pattern_core(breakpoint_graph), topologies)
+
+
+def get_bag_pattern_metric_batch(breakpoint_graph, topologies):
+    return fast_statistics.get_bag_pattern_metric_batch(get_pattern_core(breakpoint_graph), topologies)
+
+
+def get_diamond_pattern_metric_batch(breakpoint_graph, topologies):
+    return fast_statistics.get_diamond_pattern_metric_batch(get_pattern_core(breakpoint_graph), topologies)
+
+
+PATTERN_METRICS = (get_cylinder_pattern_metric_batch, get_bag_pattern_metric_batch, get_diamond_pattern_metric_batch)
+
+
+def get_cumulative_metric_batch(breakpoint_graph, topologies):
+    return sum_metric_batches(breakpoint_graph, topologies, (get_mca_metric_batch,) + PATTERN_METRICS)
+
+
+# Reference metric -> its counterpart running on the contracted graph, the rest run accelerated
+CONTRACTED_METRICS = dict(ACCELERATED_METRICS)
+CONTRACTED_METRICS.update({
+    statistics.get_simple_paths_metric: get_simple_paths_metric,
+    statistics.get_ca_metric: get_ca_metric,
+    statistics.get_mca_metric: get_mca_metric,
+    statistics.get_mca_metric_batch: get_mca_metric_batch,
+    statistics.get_cylinder_pattern_metric_batch: get_cylinder_pattern_metric_batch,
+    statistics.get_bag_pattern_metric_batch: get_bag_pattern_metric_batch,
+    statistics.get_diamond_pattern_metric_batch: get_diamond_pattern_metric_batch,
+    statistics.get_cumulative_metric_batch: get_cumulative_metric_batch,
+})
+
+
+if __name__ == '__main__':
+    from io import StringIO
+
+    from bg.bg_io import GRIMMReader
+
+    TOPOLOGIES = ((('A', 'B'), ('C', 'D')), (('A', 'C'), ('B', 'D')), (('A', 'D'), ('C', 'B')))
+
+    def test_same_as_reference():
+        breakpoint_graph = GRIMMReader.get_breakpoint_graph(StringIO('\n'.join((
+            '>A', '1 2 3 4 5 6 7 8 9 10 $',
+            '>B', '1 -3 -2 4 5 6 -8 -7 9 10 $',
+            '>C', '1 2 3 -5 -4 6 7 8 -10 -9 @',
+            '>D', '-2 -1 3 4 5 $', '6 -7 8 -10 -9 $'))))
+        assert (get_contracted_graph(breakpoint_graph).exact)
+        for reference_metric, contracted_metric in CONTRACTED_METRICS.items():
+            if contracted_metric.__name__.endswith('_batch'):
+                assert (list(reference_metric(breakpoint_graph, TOPOLOGIES)) ==
+                        list(contracted_metric(breakpoint_graph, TOPOLOGIES)))
+            else:
+                for topology in TOPOLOGIES:
+                    assert (reference_metric(breakpoint_graph, topology) ==
+                            contracted_metric(breakpoint_graph, topology))
+
+    def test_half_lengths():
+        assert (path_half_lengths(4, 0, True) == (4, 0))
+        assert (path_half_lengths(4, 0, False) == (0, 4))
+        assert (path_half_lengths(4, 1, True) == (1, 3))
+        assert (path_half_lengths(3, 3, True) == (3, 0))
+        assert (path_half_lengths(4, 4, True) == (0, 4))
+
+    test_half_lengths()
+    test_same_as_reference()
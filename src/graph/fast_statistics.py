@@ -0,0 +1,439 @@
+__author__ = 'nikita_kartashov'
+
+from collections import Counter, defaultdict
+from math import ceil
+
+from src.graph import statistics
+from src.graph.branch import compute_tree_score_with_branches
+from src.graph.breakpoint_graph_extensions import multicolor_to_normalized_split
+from src.graph.statistics import get_score_on_topology_favouring, sum_metric_batches, ALL_GENOMES, NEGATIVE
+
+# Accelerated counterparts of the metrics from statistics.py. They walk a plain dict based index
+# of the BP graph built once per graph instead of wrapping every visited edge into BGEdge objects,
+# and they follow exactly the same traversal orders, so the scores are identical to the reference ones.
+
+
+def multicolor_key(multicolor):
+    """
+    Returns a hashable value which is equal for two multicolors iff they are equal
+    :param multicolor: bg Multicolor
+    :return: frozenset of (color, multiplicity) pairs
+    """
+    return frozenset((color, multiplicity) for color, multiplicity in multicolor.multicolors.items()
+                     if multiplicity > 0)
+
+
+def colors_key(colors):
+    return frozenset(Counter(colors).items())
+
+
+class AdjacencyGraph(object):
+    def __init__(self, breakpoint_graph):
+        """
+        Indexes a BP graph, keeping the iteration orders of its nodes, edges and neighbours
+        :param breakpoint_graph: bg BreakpointGraph
+        :return: the resulting object
+        """
+        self.nodes = tuple(breakpoint_graph.nodes())
+        # (neighbour, multicolor key, colors) for every multiedge from the vertex
+        self.neighbours = {}
+        self.coloured_neighbours = {}
+        for node in self.nodes:
+            neighbours = tuple((edge.vertex2, multicolor_key(edge.multicolor), frozenset(edge.multicolor.colors))
+                               for edge in breakpoint_graph.get_edges_by_vertex(node))
+            self.neighbours[node] = neighbours
+            coloured_neighbours = defaultdict(list)
+            for neighbour, key, _ in neighbours:
+                coloured_neighbours[key].append(neighbour)
+            self.coloured_neighbours[node] = dict(coloured_neighbours)
+        self.edges = tuple((edge.vertex1, edge.vertex2, multicolor_key(edge.multicolor),
+                            frozenset(edge.multicolor.colors))
+                           for edge in breakpoint_graph.edges())
+        # Multicolor of the edge get_edge_by_two_vertices would return, i.e. the one with the smallest key
+        self.edge_between = {}
+        for node in self.nodes:
+            for neighbour, edges in breakpoint_graph.bg[node].items():
+                self.edge_between[node, neighbour] = multicolor_key(edges[min(edges)]['multicolor'])
+        self._cache = {}
+
+    def cached(self, name, f):
+        if name not in self._cache:
+            self._cache[name] = f()
+        return self._cache[name]
+
+    def sized_neighbours(self, vertex, size):
+        return ((neighbour, key, colors) for neighbour, key, colors in self.neighbours[vertex] if len(colors) == size)
+
+    def multidegree(self, vertex):
+        return len(self.neighbours[vertex])
+
+    def without_nodes(self, removed_nodes):
+        """
+        Indexes the subgraph induced by all nodes but the given ones, keeping the iteration orders
+        :param removed_nodes: set of nodes to leave out
+        :return: AdjacencyGraph
+        """
+        subgraph = AdjacencyGraph.__new__(AdjacencyGraph)
+        subgraph.nodes = tuple(node for node in self.nodes if node not in removed_nodes)
+        subgraph.neighbours = {}
+        subgraph.coloured_neighbours = {}
+        for node in subgraph.nodes:
+            subgraph.neighbours[node] = tuple(neighbour for neighbour in self.neighbours[node]
+                                              if neighbour[0] not in removed_nodes)
+            subgraph.coloured_neighbours[node] = {key: [v for v in vertices if v not in removed_nodes]
+                                                  for key, vertices in self.coloured_neighbours[node].items()}
+        subgraph.edges = tuple(edge for edge in self.edges
+                               if edge[0] not in removed_nodes and edge[1] not in removed_nodes)
+        subgraph.edge_between = {(vertex1, vertex2): key for (vertex1, vertex2), key in self.edge_between.items()
+                                 if vertex1 not in removed_nodes and vertex2 not in removed_nodes}
+        subgraph._cache = {}
+        return subgraph
+
+    def relabelled(self):
+        """
+        Copies the index replacing nodes by their positions in the node order, which is all the metrics
+        depend on. Integer nodes are cheaper to hash and to pickle
+        :return: AdjacencyGraph
+        """
+        # Nodes are looked up by identity, as hashing of bg vertices goes through Python code
+        label_by_id = dict((id(node), i) for i, node in enumerate(self.nodes))
+        label_by_node = {}
+
+        def label(node):
+            i = label_by_id.get(id(node))
+            if i is None:
+                if not label_by_node:
+                    label_by_node.update((node, i) for i, node in enumerate(self.nodes))
+                i = label_by_node[node]
+            return i
+
+        # Equal multicolors become the same objects, so that pickle stores each of them once
+        interned = {}
+
+        def intern(value):
+            return interned.setdefault(value, value)
+
+        copy = AdjacencyGraph.__new__(AdjacencyGraph)
+        copy.nodes = tuple(range(len(self.nodes)))
+        copy.neighbours = {}
+        copy.coloured_neighbours = {}
+        copy.edge_between = {}
+        for i, node in enumerate(self.nodes):
+            neighbours = tuple((label(neighbour), intern(key), intern(colors))
+                               for neighbour, key, colors in self.neighbours[node])
+            copy.neighbours[i] = neighbours
+            coloured_neighbours = defaultdict(list)
+            for neighbour, key, _ in neighbours:
+                coloured_neighbours[key].append(neighbour)
+            copy.coloured_neighbours[i] = dict(coloured_neighbours)
+        for (vertex1, vertex2), key in self.edge_between.items():
+            copy.edge_between[label(vertex1), label(vertex2)] = intern(key)
+        copy.edges = tuple((label(vertex1), label(vertex2), intern(key), intern(colors))
+                           for vertex1, vertex2, key, colors in self.edges)
+        copy._cache = {}
+        return copy
+
+    def partition(self, node_groups):
+        """
+        Indexes subgraphs induced by groups of nodes in a single pass, keeping the iteration orders.
+        Every group must be a union of connected components
+        :param node_groups: list of sets of nodes
+        :return: list of AdjacencyGraph, one per group
+        """
+        group_of = dict((node, i) for i, nodes in enumerate(node_groups) for node in nodes)
+        subgraphs = []
+        for _ in node_groups:
+            subgraph = AdjacencyGraph.__new__(AdjacencyGraph)
+            subgraph.nodes, subgraph.neighbours, subgraph.coloured_neighbours = [], {}, {}
+            subgraph.edges, subgraph.edge_between, subgraph._cache = [], {}, {}
+            subgraphs.append(subgraph)
+        for node in self.nodes:
+            subgraph = subgraphs[group_of[node]]
+            subgraph.nodes.append(node)
+            subgraph.neighbours[node] = self.neighbours[node]
+            subgraph.coloured_neighbours[node] = self.coloured_neighbours[node]
+            for neighbour, _, _ in self.neighbours[node]:
+                subgraph.edge_between[node, neighbour] = self.edge_between[node, neighbour]
+        for edge in self.edges:
+            subgraphs[group_of[edge[0]]].edges.append(edge)
+        for subgraph in subgraphs:
+            subgraph.nodes, subgraph.edges = tuple(subgraph.nodes), tuple(subgraph.edges)
+        return subgraphs
+
+
+_last_indexed = [None, None]
+
+
+def get_adjacency_graph(breakpoint_graph):
+    """
+    Returns the index of the graph, reusing it while the same graph is scored by several metrics
+    :param breakpoint_graph: bg BreakpointGraph or an already built AdjacencyGraph
+    :return: AdjacencyGraph
+    """
+    if isinstance(breakpoint_graph, AdjacencyGraph):
+        return breakpoint_graph
+    if _last_indexed[0] is not breakpoint_graph:
+        _last_indexed[:] = breakpoint_graph, AdjacencyGraph(breakpoint_graph)
+    return _last_indexed[1]
+
+
+def get_distribution_metric(breakpoint_graph, tree_topology):
+    graph = get_adjacency_graph(breakpoint_graph)
+    distribution = graph.cached('distribution', lambda: tuple(Counter(
+        multicolor_to_normalized_split(colors, ALL_GENOMES) for _, _, _, colors in graph.edges).items()))
+    return NEGATIVE * compute_tree_score_with_branches(distribution, tree_topology)
+
+
+def get_simple_paths_metric(breakpoint_graph, tree_topology):
+    graph = get_adjacency_graph(breakpoint_graph)
+
+    def count_simple_splits():
+        result = defaultdict(lambda: 0)
+        for vertex1, vertex2, _, colors in graph.edges:
+            if graph.multidegree(vertex1) == 2 and graph.multidegree(vertex2) == 2:
+                result[multicolor_to_normalized_split(colors, ALL_GENOMES)] += 1
+        return tuple(result.items())
+
+    return NEGATIVE * compute_tree_score_with_branches(graph.cached('simple_paths', count_simple_splits),
+                                                       tree_topology)
+
+
+def get_bp_distance_two_genomes(breakpoint_graph, genomes):
+    graph = get_adjacency_graph(breakpoint_graph)
+    block_number = len(graph.nodes) / 2
+    left, right = genomes
+    common_adjacencies = frozenset((frozenset((vertex1, vertex2)), key) for vertex1, vertex2, key, colors in graph.edges
+                                   if left in colors and right in colors)
+    return block_number - len(common_adjacencies)
+
+
+def get_dcj_distance_two_genomes(breakpoint_graph, genomes):
+    graph = get_adjacency_graph(breakpoint_graph)
+    block_number = len(graph.nodes) / 2
+    connected_components = 0
+    visited = set()
+    for node in graph.nodes:
+        if node in visited:
+            continue
+        connected_components += 1
+        next_node = node
+
+        while next_node is not None:
+            vertex = next_node
+            next_node = None
+            visited.add(vertex)
+            # As in the reference implementation the walk follows the last suitable edge only
+            for neighbour, _, colors in graph.neighbours[vertex]:
+                if neighbour not in visited and any(genome in colors for genome in genomes):
+                    next_node = neighbour
+
+    return block_number - connected_components
+
+
+def get_bp_distance_metric(breakpoint_graph, tree_topology):
+    return int(sum(get_bp_distance_two_genomes(breakpoint_graph, pair_genomes) for pair_genomes in tree_topology))
+
+
+def get_dcj_distance_metric(breakpoint_graph, tree_topology):
+    return int(sum(get_dcj_distance_two_genomes(breakpoint_graph, pair_genomes) for pair_genomes in tree_topology))
+
+
+def traverse_node_starting_in_color(graph, start_node, start_color, alternate_color, visited,
+                                    traverse_paths_instead_of_cycles=True):
+    current_node = start_node
+    current_color = start_color
+    alternating_traversal_path_length = 0
+    while True:
+        visited.add(current_node)
+        next_node = next((v for v in graph.coloured_neighbours[current_node].get(current_color, ())
+                          if v not in visited), None)
+        if next_node is not None:
+            current_node = next_node
+        else:
+            # The reference leaf check never fires, so every traversed cycle gets its missing edge
+            if not traverse_paths_instead_of_cycles and alternating_traversal_path_length > 0:
+                alternating_traversal_path_length += 1
+            break
+
+        current_color = alternate_color(current_color)
+        alternating_traversal_path_length += 1
+
+    return alternating_traversal_path_length
+
+
+def get_size_of_alternating_structures(breakpoint_graph, colors, modifier=lambda x: x,
+                                       get_size_of_paths_instead_of_cycles=True):
+    graph = get_adjacency_graph(breakpoint_graph)
+    colors = tuple(map(colors_key, colors))
+    color1, color2 = colors
+
+    def alternate_color(color):
+        return color2 if color == color1 else color1
+
+    visited = set()
+    resulting_length = 0
+    for node in graph.nodes:
+        if node in visited:
+            continue
+        for color in colors:
+            resulting_length += modifier(traverse_node_starting_in_color(
+                graph, node, color, alternate_color, visited, get_size_of_paths_instead_of_cycles))
+    return resulting_length
+
+
+def get_ca_metric(breakpoint_graph, tree_topology):
+    def halver(value):
+        return ceil(value * 1.0 / 2)
+
+    return NEGATIVE * get_size_of_alternating_structures(breakpoint_graph, tree_topology, halver)
+
+
+def get_mca_metric(breakpoint_graph, tree_topology):
+    def cycle_specific_halver(value):
+        return value / 2 - 1
+
+    ca_score = get_ca_metric(breakpoint_graph, tree_topology)
+    cycles_length = get_size_of_alternating_structures(breakpoint_graph, tree_topology, cycle_specific_halver,
+                                                       get_size_of_paths_instead_of_cycles=False)
+    return ca_score + NEGATIVE * cycles_length
+
+
+def get_mca_metric_batch(breakpoint_graph, topologies):
+    return ((get_mca_metric(breakpoint_graph, topology), topology) for topology in topologies)
+
+
+def cylinder_patterns_from(graph, start_node):
+    """
+    Yields cylinder patterns found from the start node, in the order the reference search assigns them
+    :param graph: AdjacencyGraph
+    :param start_node: node to start from
+    :return: generator of (frozenset of pattern vertices, double colors)
+    """
+    for double_vertex, double_key, double_colors in graph.sized_neighbours(start_node, 2):
+        for single_vertex, single_key, _ in graph.sized_neighbours(start_node, 1):
+            start_to_single_to_double = frozenset(graph.coloured_neighbours[single_vertex].get(double_key, ()))
+            if len(start_to_single_to_double) == 0:
+                continue
+
+            start_to_double_to_new_single = frozenset(
+                neighbour for neighbour, _, _ in graph.sized_neighbours(double_vertex, 1))
+            if len(start_to_double_to_new_single) == 0:
+                continue
+
+            for final_vertex in start_to_single_to_double.intersection(start_to_double_to_new_single):
+                if graph.edge_between[final_vertex, double_vertex] != single_key:
+                    yield frozenset([start_node, single_vertex, double_vertex, final_vertex]), double_colors
+
+
+def bag_patterns_from(graph, start_node):
+    for double_vertex, double_key, double_colors in graph.sized_neighbours(start_node, 2):
+        # Colors are compared the way get_vertex_coloured_sized_neighbours does it
+        double_color_sets = tuple(frozenset(color) for color in double_colors)
+        for single_vertex, single_key, _ in graph.sized_neighbours(start_node, 1):
+            for final_vertex, _, final_colors in graph.sized_neighbours(single_vertex, 1):
+                if not any(color_set.issubset(final_colors) for color_set in double_color_sets):
+                    continue
+                if any(neighbour == double_vertex for neighbour, _, _ in graph.sized_neighbours(final_vertex, 1)) \
+                        and graph.edge_between[double_vertex, final_vertex] != single_key:
+                    yield frozenset([start_node, single_vertex, double_vertex, final_vertex]), double_colors
+
+
+def diamond_patterns_from(graph, start_node):
+    for first_vertex, first_key, first_colors in graph.sized_neighbours(start_node, 1):
+        for second_vertex, second_key, second_colors in graph.sized_neighbours(start_node, 1):
+            if second_key == first_key:
+                continue
+            for third_vertex, third_key, _ in graph.sized_neighbours(second_vertex, 1):
+                if third_key == first_key or third_key == second_key:
+                    continue
+                last_key = graph.edge_between.get((third_vertex, first_vertex))
+                if last_key is None:
+                    continue
+                if last_key != first_key and last_key != second_key and last_key != third_key:
+                    yield frozenset([start_node, first_vertex, second_vertex, third_vertex]), \
+                        first_colors | second_colors
+
+
+def find_patterns(breakpoint_graph, patterns_from):
+    graph = get_adjacency_graph(breakpoint_graph)
+    # Later assignments to the same pattern win, as in the reference dicts
+    return dict(pattern for start_node in graph.nodes for pattern in patterns_from(graph, start_node))
+
+
+def find_cylinder_patterns(breakpoint_graph):
+    return find_patterns(breakpoint_graph, cylinder_patterns_from)
+
+
+def find_bag_patterns(breakpoint_graph):
+    return find_patterns(breakpoint_graph, bag_patterns_from)
+
+
+def find_diamond_patterns(breakpoint_graph):
+    return find_patterns(breakpoint_graph, diamond_patterns_from)
+
+
+def get_pattern_metric_batch(patterns, topologies):
+    return ((NEGATIVE *
+             sum(get_score_on_topology_favouring(topology, double_color)
+                 for double_color in patterns.values()), topology)
+            for topology in topologies)
+
+
+def get_cylinder_pattern_metric_batch(breakpoint_graph, topologies):
+    return get_pattern_metric_batch(find_cylinder_patterns(breakpoint_graph), topologies)
+
+
+def get_bag_pattern_metric_batch(breakpoint_graph, topologies):
+    return get_pattern_metric_batch(find_bag_patterns(breakpoint_graph), topologies)
+
+
+def get_diamond_pattern_metric_batch(breakpoint_graph, topologies):
+    return get_pattern_metric_batch(find_diamond_patterns(breakpoint_graph), topologies)
+
+
+PATTERN_METRICS = (get_cylinder_pattern_metric_batch, get_bag_pattern_metric_batch, get_diamond_pattern_metric_batch)
+
+
+def get_cumulative_metric_batch(breakpoint_graph, topologies):
+    return sum_metric_batches(breakpoint_graph, topologies, (get_mca_metric_batch,) + PATTERN_METRICS)
+
+
+# Reference metric -> its accelerated counterpart
+ACCELERATED_METRICS = {
+    statistics.get_distribution_metric: get_distribution_metric,
+    statistics.get_simple_paths_metric: get_simple_paths_metric,
+    statistics.get_bp_distance_metric: get_bp_distance_metric,
+    statistics.get_dcj_distance_metric: get_dcj_distance_metric,
+    statistics.get_ca_metric: get_ca_metric,
+    statistics.get_mca_metric: get_mca_metric,
+    statistics.get_mca_metric_batch: get_mca_metric_batch,
+    statistics.get_cylinder_pattern_metric_batch: get_cylinder_pattern_metric_batch,
+    statistics.get_bag_pattern_metric_batch: get_bag_pattern_metric_batch,
+    statistics.get_diamond_pattern_metric_batch: get_diamond_pattern_metric_batch,
+    statistics.get_cumulative_metric_batch: get_cumulative_metric_batch,
+}
+
+
+if __name__ == '__main__':
+    from io import StringIO
+
+    from bg.bg_io import GRIMMReader
+
+    TOPOLOGIES = ((('A', 'B'), ('C', 'D')), (('A', 'C'), ('B', 'D')), (('A', 'D'), ('C', 'B')))
+
+    def test_same_as_reference():
+        breakpoint_graph = GRIMMReader.get_breakpoint_graph(StringIO('\n'.join((
+            '>A', '1 2 3 4 5 6 7 8 $',
+            '>B', '1 -3 -2 4 5 6 -8 -7 $',
+            '>C', '1 2 3 -5 -4 6 7 8 @',
+            '>D', '-2 -1 3 4 5 $', '6 -7 8 $'))))
+        for reference_metric, accelerated_metric in ACCELERATED_METRICS.items():
+            if accelerated_metric.__name__.endswith('_batch'):
+                assert (list(reference_metric(breakpoint_graph, TOPOLOGIES)) ==
+                        list(accelerated_metric(breakpoint_graph, TOPOLOGIES)))
+            else:
+                for topology in TOPOLOGIES:
+                    assert (reference_metric(breakpoint_graph, topology) ==
+                            accelerated_metric(breakpoint_graph, topology))
+
+    test_same_as_reference()
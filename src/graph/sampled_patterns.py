@@ -0,0 +1,231 @@
+__author__ = 'nikita_kartashov'
+
+from sys import argv
+from math import sqrt
+from random import Random
+
+from src.graph import statistics
+from src.graph.fast_statistics import get_adjacency_graph, find_patterns, get_pattern_metric_batch, \
+    get_mca_metric_batch, cylinder_patterns_from, bag_patterns_from, diamond_patterns_from, ACCELERATED_METRICS
+from src.graph.statistics import get_score_on_topology_favouring, NEGATIVE
+
+# Approximate pattern metrics. Start nodes are sampled without replacement and every pattern found from
+# a sampled node is weighted by one over the number of its nodes it is found from, so the sum of the weights
+# over all nodes is exactly the number of patterns, and the mean over the sample estimates it unbiasedly.
+# Sampling goes on until the confidence intervals of all topology scores are narrow enough.
+
+DEFAULT_ERROR_TARGET = 0.05
+# Two-sided 95% confidence
+DEFAULT_Z_SCORE = 1.96
+# Graphs with at most this many nodes are always counted exactly
+EXACT_NODE_LIMIT = 10000
+MIN_SAMPLE_SIZE = 100
+# Patterns are rare, so the variance is only trusted once the sample has found enough of them
+MIN_SAMPLED_PATTERNS = 50
+SAMPLE_BATCH = 100
+# Sampling gives up and counts exactly once it has sampled or is expected to need this fraction of nodes,
+# so that a failed estimate costs at most this fraction of a scan on top of the exact counting
+EXACT_SAMPLE_FRACTION = 0.25
+
+PATTERN_SEARCHES = (cylinder_patterns_from, bag_patterns_from, diamond_patterns_from)
+
+
+class Estimate(float):
+    def __new__(cls, score, half_width):
+        """
+        Score estimated by sampling, which carries the half-width of its confidence interval along
+        :param score: estimated score
+        :param half_width: confidence half-width of the score
+        :return: the resulting object
+        """
+        estimate = super().__new__(cls, score)
+        estimate.half_width = half_width
+        return estimate
+
+    def __reduce__(self):
+        return Estimate, (float(self), self.half_width)
+
+
+def add_scores(scores):
+    """
+    Sums scores of independent parts, e.g. of metrics or of shards
+    :param scores: iterable of exact scores and Estimate objects
+    :return: the sum, an Estimate with the half-widths added in quadrature if any part is estimated
+    """
+    scores = list(scores)
+    half_width = sqrt(sum(getattr(score, 'half_width', 0) ** 2 for score in scores))
+    total = sum(scores)
+    return Estimate(total, half_width) if half_width > 0 else total
+
+
+def get_pattern_weights(graph, patterns_from, start_node, known_patterns):
+    """
+    Returns colors and weights of the patterns found from the start node
+    :param graph: AdjacencyGraph
+    :param patterns_from: pattern search from a single node, like cylinder_patterns_from
+    :param start_node: sampled node
+    :param known_patterns: dict from patterns to (colors, weight) shared between calls
+    :return: list of (colors, weight)
+    """
+    result = []
+    for pattern in set(pattern for pattern, _ in patterns_from(graph, start_node)):
+        if pattern not in known_patterns:
+            rank = graph.cached('node_rank', lambda: dict((node, i) for i, node in enumerate(graph.nodes)))
+            finder_number, pattern_colors = 0, None
+            # Colors assigned last by the exhaustive search, which goes through the nodes in order
+            for node in sorted(pattern, key=rank.get):
+                found_colors = [colors for found, colors in patterns_from(graph, node) if found == pattern]
+                if found_colors:
+                    finder_number += 1
+                    pattern_colors = found_colors[-1]
+            known_patterns[pattern] = (pattern_colors, 1.0 / finder_number)
+        result.append(known_patterns[pattern])
+    return result
+
+
+def estimate_pattern_metric_batch(breakpoint_graph, topologies, searches=PATTERN_SEARCHES,
+                                  error_target=DEFAULT_ERROR_TARGET, z_score=DEFAULT_Z_SCORE,
+                                  exact_node_limit=EXACT_NODE_LIMIT, random=None):
+    """
+    Estimates the summary score of pattern metrics by sampling start nodes
+    :param breakpoint_graph: given BP graph
+    :param topologies: tuple of topologies, each of which is in the form (('A', 'B'), ('C', 'D'))
+    :param searches: pattern searches from a single node, the scores of which are summed
+    :param error_target: sampling stops once the confidence half-width of every score is at most
+    this fraction of the score (of 1 for scores closer to zero)
+    :param z_score: normal quantile of the confidence level
+    :param exact_node_limit: graphs with at most this many nodes are counted exactly
+    :param random: random.Random to sample with
+    :return: (list of (score, confidence half-width, topology), number of sampled start nodes),
+    exact scores have zero half-width
+    """
+    graph = get_adjacency_graph(breakpoint_graph)
+    topologies = tuple(topologies)
+    population = len(graph.nodes)
+
+    def exact_scores():
+        scored_rows = [tuple(get_pattern_metric_batch(find_patterns(graph, patterns_from), topologies))
+                       for patterns_from in searches]
+        return [(sum(row[i][0] for row in scored_rows), 0, topology)
+                for i, topology in enumerate(topologies)], population
+
+    if population <= exact_node_limit:
+        return exact_scores()
+
+    random = Random() if random is None else random
+    known_patterns = [{} for _ in searches]
+    sums = [0.0] * len(topologies)
+    square_sums = [0.0] * len(topologies)
+    sample_size = sampled_patterns = 0
+    for start_node in random.sample(graph.nodes, population):
+        weighted_colors = [weighted for patterns_from, known in zip(searches, known_patterns)
+                           for weighted in get_pattern_weights(graph, patterns_from, start_node, known)]
+        sample_size += 1
+        if weighted_colors:
+            sampled_patterns += len(weighted_colors)
+            for i, topology in enumerate(topologies):
+                value = sum(weight * get_score_on_topology_favouring(topology, colors)
+                            for colors, weight in weighted_colors)
+                sums[i] += value
+                square_sums[i] += value * value
+        if sample_size == population:
+            # Every node is sampled, so the sums are the exact scores, up to the rounding of the weights
+            return [(NEGATIVE * round(sums[i]), 0, topology) for i, topology in enumerate(topologies)], sample_size
+        if sample_size >= EXACT_SAMPLE_FRACTION * population:
+            return exact_scores()
+        if sample_size < MIN_SAMPLE_SIZE or sample_size % SAMPLE_BATCH != 0:
+            continue
+        if sampled_patterns < MIN_SAMPLED_PATTERNS:
+            # Nodes needed to find enough patterns at the rate seen so far, which is overestimated by one
+            # pattern so that not having found any yet does not look like a rate of zero
+            if MIN_SAMPLED_PATTERNS * sample_size / (sampled_patterns + 1.0) >= EXACT_SAMPLE_FRACTION * population:
+                return exact_scores()
+            continue
+
+        estimates = []
+        required_size = 0
+        for i, topology in enumerate(topologies):
+            mean = sums[i] / sample_size
+            variance = max(square_sums[i] - sample_size * mean * mean, 0) / (sample_size - 1)
+            # Finite population correction, as the nodes are sampled without replacement
+            half_width = z_score * population * sqrt(variance / sample_size * (1 - sample_size / population))
+            score = NEGATIVE * population * mean
+            estimates.append((score, half_width, topology))
+            # Sample size reaching the error target if the variance stays the same
+            target_size = (z_score * population * sqrt(variance) / (error_target * max(abs(score), 1))) ** 2
+            required_size = max(required_size, target_size / (1 + target_size / population))
+        if all(half_width <= error_target * max(abs(score), 1) for score, half_width, _ in estimates):
+            return estimates, sample_size
+        if required_size >= EXACT_SAMPLE_FRACTION * population:
+            return exact_scores()
+    return exact_scores()
+
+
+def sampled_pattern_metric_batch(searches):
+    def metric(breakpoint_graph, topologies):
+        scores, _ = estimate_pattern_metric_batch(breakpoint_graph, topologies, searches)
+        return ((Estimate(score, half_width) if half_width > 0 else score, topology)
+                for score, half_width, topology in scores)
+
+    return metric
+
+
+get_cylinder_pattern_metric_batch = sampled_pattern_metric_batch((cylinder_patterns_from,))
+get_bag_pattern_metric_batch = sampled_pattern_metric_batch((bag_patterns_from,))
+get_diamond_pattern_metric_batch = sampled_pattern_metric_batch((diamond_patterns_from,))
+get_patterns_metric_batch = sampled_pattern_metric_batch(PATTERN_SEARCHES)
+
+
+def get_cumulative_metric_batch(breakpoint_graph, topologies):
+    # Summed without numpy, which would drop the half-widths of the estimates
+    topologies = tuple(topologies)
+    return ((add_scores((mca_score, pattern_score)), topology)
+            for (mca_score, topology), (pattern_score, _) in
+            zip(get_mca_metric_batch(breakpoint_graph, topologies),
+                get_patterns_metric_batch(breakpoint_graph, topologies)))
+
+
+# Reference metric -> its counterpart with sampled patterns, the rest run accelerated
+SAMPLED_METRICS = dict(ACCELERATED_METRICS)
+SAMPLED_METRICS.update({
+    statistics.get_cylinder_pattern_metric_batch: get_cylinder_pattern_metric_batch,
+    statistics.get_bag_pattern_metric_batch: get_bag_pattern_metric_batch,
+    statistics.get_diamond_pattern_metric_batch: get_diamond_pattern_metric_batch,
+    statistics.get_cumulative_metric_batch: get_cumulative_metric_batch,
+})
+
+
+if __name__ == '__main__':
+    from time import time
+
+    from bg.bg_io import GRIMMReader
+
+    TOPOLOGIES = ((('A', 'B'), ('C', 'D')), (('A', 'C'), ('B', 'D')), (('A', 'D'), ('C', 'B')))
+
+    if len(argv) < 2:
+        print('Usage: python -m src.graph.sampled_patterns <blocks file> [error target] [z score]')
+        exit(1)
+
+    with open(argv[1]) as block_file:
+        breakpoint_graph = GRIMMReader.get_breakpoint_graph(block_file)
+    error_target = float(argv[2]) if len(argv) > 2 else DEFAULT_ERROR_TARGET
+    z_score = float(argv[3]) if len(argv) > 3 else DEFAULT_Z_SCORE
+    # Both countings share the index of the graph
+    get_adjacency_graph(breakpoint_graph)
+
+    start = time()
+    exact, _ = estimate_pattern_metric_batch(breakpoint_graph, TOPOLOGIES, exact_node_limit=len(breakpoint_graph.bg))
+    exact_time = time() - start
+    start = time()
+    estimated, sample_size = estimate_pattern_metric_batch(breakpoint_graph, TOPOLOGIES, error_target=error_target,
+                                                           z_score=z_score, exact_node_limit=0)
+    estimated_time = time() - start
+
+    if sample_size < len(breakpoint_graph.bg):
+        print('Sampled {0} of {1} start nodes in {2:.3f}s, exact counting took {3:.3f}s'.format(
+            sample_size, len(breakpoint_graph.bg), estimated_time, exact_time))
+    else:
+        print('Sampling gave up and counted all {0} start nodes in {1:.3f}s, exact counting took {2:.3f}s'.format(
+            len(breakpoint_graph.bg), estimated_time, exact_time))
+    for (exact_score, _, topology), (score, half_width, _) in zip(exact, estimated):
+        print('{0}\texact={1}\testimate={2:.1f} +- {3:.1f}'.format(topology, exact_score, score, half_width))
@@ -2,8 +2,9 @@ __author__ = 'nikita_kartashov'
 
 from collections import Counter, defaultdict
 from math import ceil
-from itertools import chain
-from functools import reduce
+
+import numpy as np
+from bg import Multicolor
 
 from src.graph.cached_statistic import CachedStatistic
 from src.graph.hashable_edge import HashableEdge
@@ -286,6 +287,8 @@ def find_diamond_patterns(breakpoint_graph):
                                                  if e.multicolor != first_edge.multicolor and
                                                                  e.multicolor != second_edge.multicolor):
                     last_edge = breakpoint_graph.get_edge_by_two_vertices(third_vertex, first_vertex)
+                    if last_edge is None:
+                        continue
                     if last_edge.multicolor != first_edge.multicolor and \
                                     last_edge.multicolor != second_edge.multicolor and \
                                     last_edge.multicolor != third_edge.multicolor:
@@ -349,23 +352,26 @@ def get_diamond_pattern_metric_batch(breakpoint_graph, topologies):
 PATTERN_METRICS = (get_cylinder_pattern_metric_batch, get_bag_pattern_metric_batch, get_diamond_pattern_metric_batch)
 
 
-def transpose(l):
-    return tuple(zip(*l))
+def sum_metric_batches(breakpoint_graph, topologies, metrics):
+    """
+    Scores every topology with the sum of scores of the given batch metrics
+    :param breakpoint_graph: given BP graph to score against
+    :param topologies: tuple of topologies, each of which is in the form (('A', 'B'), ('C', 'D'))
+    :param metrics: batch metrics to sum
+    :return: iterable of topologies with scores
+    """
+    topologies = tuple(topologies)
+    # Rows are added one after another, in the order of the metrics
+    scores = np.array([[score for score, _ in metric(breakpoint_graph, topologies)] for metric in metrics])
+    return zip(scores.sum(axis=0).tolist(), topologies)
 
 
 def get_cumulative_metric_batch(breakpoint_graph, topologies):
-    mca = get_mca_metric_batch(breakpoint_graph, topologies)
-    pattern_metrics = (metric(breakpoint_graph, topologies) for metric in PATTERN_METRICS)
-
-    def reducer(acc, new_value):
-        return acc[0] + new_value[0], acc[1]
-
-    return (reduce(reducer, topology_row) for topology_row in
-            transpose(tuple(map(tuple, chain((mca,), pattern_metrics)))))
+    return sum_metric_batches(breakpoint_graph, topologies, (get_mca_metric_batch,) + PATTERN_METRICS)
 
 
 if __name__ == '__main__':
-    from bg import BreakpointGraph, Multicolor
+    from bg import BreakpointGraph
     from networkx import MultiGraph
 
     def test_cylinder():
@@ -0,0 +1,267 @@
+__author__ = 'nikita_kartashov'
+
+from collections import Counter
+from itertools import combinations
+
+from src.graph.statistics import get_mca_metric, NEGATIVE
+
+DEFAULT_MAX_RESULTS = 10
+
+# Topologies are searched by stepwise addition: leaves are inserted one by one into every edge of
+# a partial tree. A tree is kept as the set of its clades when rooted at the reference (smallest)
+# genome, so every edge corresponds to exactly one clade (the side not containing the reference),
+# and any split of the genomes is identified by the same kind of clade.
+
+
+def get_genomes(breakpoint_graph):
+    return frozenset().union(*(edge.multicolor.colors for edge in breakpoint_graph.edges()))
+
+
+def get_reference_genome(genomes):
+    return min(genomes)
+
+
+def split_to_clade(colors, genomes):
+    """
+    Returns the side of the split induced by colors which does not contain the reference genome
+    :param colors: colors of one side of the split
+    :param genomes: all genomes as a frozenset
+    :return: frozenset of genomes
+    """
+    side = frozenset(colors) & genomes
+    return genomes - side if get_reference_genome(genomes) in side else side
+
+
+def is_clade_trivial(clade, genomes):
+    return len(clade) <= 1 or len(clade) >= len(genomes) - 1
+
+
+def get_distribution_split_scores(breakpoint_graph, genomes):
+    """
+    Scores splits as the distribution metric does, i.e. by the number of edges inducing them
+    :param breakpoint_graph: given BP graph
+    :param genomes: all genomes as a frozenset
+    :return: dict from nontrivial clades to their scores and the summary score of trivial splits
+    """
+    distribution = Counter(split_to_clade(edge.multicolor.colors, genomes) for edge in breakpoint_graph.edges())
+    trivial_score = sum(NEGATIVE * count for clade, count in distribution.items() if is_clade_trivial(clade, genomes))
+    return {clade: NEGATIVE * count for clade, count in distribution.items()
+            if not is_clade_trivial(clade, genomes)}, trivial_score
+
+
+def metric_split_scorer(metric=get_mca_metric):
+    """
+    Makes a split scorer out of a topology metric like CA or MCA, which treats a split as a pair of colors
+    :param metric: metric taking breakpoint graph and a pair of genome tuples
+    :return: function from breakpoint graph and genomes to split scores and the trivial score
+    """
+
+    def scorer(breakpoint_graph, genomes):
+        reference = get_reference_genome(genomes)
+        others = sorted(genomes - {reference})
+        split_scores = {}
+        for size in range(2, len(genomes) - 1):
+            for clade in map(frozenset, combinations(others, size)):
+                split_scores[clade] = metric(breakpoint_graph, (tuple(sorted(genomes - clade)), tuple(sorted(clade))))
+        return split_scores, 0
+
+    return scorer
+
+
+def insert_leaf(clades, clade, leaf):
+    """
+    Inserts a leaf into the edge above the given clade
+    :param clades: frozenset of clades of the partial tree
+    :param clade: clade denoting the edge
+    :param leaf: new leaf
+    :return: frozenset of clades of the new tree
+    """
+    return frozenset(chain_clade | {leaf} if clade < chain_clade else chain_clade for chain_clade in clades) | \
+        frozenset([frozenset([leaf]), clade | {leaf}])
+
+
+def initial_clades(first, second):
+    first, second = frozenset([first]), frozenset([second])
+    return frozenset([first, second, first | second])
+
+
+def generate_topologies(genomes):
+    """
+    Generates all unrooted binary topologies on given genomes
+    :param genomes: iterable of at least three genome names
+    :return: generator of topologies in the form of nested tuples
+    """
+    genomes = sorted(genomes)
+    reference = genomes[0]
+
+    def generate(clades, leaves_left):
+        if not leaves_left:
+            yield clades_to_topology(clades, reference)
+            return
+        for clade in clades:
+            yield from generate(insert_leaf(clades, clade, leaves_left[0]), leaves_left[1:])
+
+    yield from generate(initial_clades(genomes[1], genomes[2]), genomes[3:])
+
+
+def clades_to_topology(clades, reference):
+    """
+    Converts the set of clades to nested tuples rooted next to the reference genome,
+    for quartets the result has the same form as (('A', 'B'), ('C', 'D'))
+    :param clades: frozenset of clades
+    :param reference: reference genome
+    :return: topology in the form of nested tuples
+    """
+    def children(clade):
+        subclades = [other for other in clades if other < clade]
+        return sorted((other for other in subclades if not any(other < another for another in subclades)),
+                      key=min)
+
+    def nested(clade):
+        if len(clade) == 1:
+            return next(iter(clade))
+        return tuple(map(nested, children(clade)))
+
+    top = max(clades, key=len)
+    smaller, larger = sorted(children(top), key=lambda clade: (len(clade), min(clade)))
+    return (reference, nested(smaller)), nested(larger)
+
+
+def search_topologies(split_scores, genomes, trivial_score=0, tolerance=0, max_results=DEFAULT_MAX_RESULTS):
+    """
+    Branch-and-bound search for the topologies with the smallest sum of split scores.
+    A partial tree on a subset of genomes is bounded from below by summing the n - 3 smallest scores
+    among the splits which may still appear in its completions, i.e. which restricted to the placed
+    genomes are trivial or already present in the partial tree. Unless every split is scored, the absent
+    ones score 0 and only negative scores take part in the bound
+    :param split_scores: dict from nontrivial clades (see split_to_clade) to scores, absent clades score 0
+    :param genomes: all genomes, at least three of them
+    :param trivial_score: score added to every topology
+    :param tolerance: topologies scoring within tolerance from the best one are reported too
+    :param max_results: maximal number of reported topologies
+    :return: list of (score, topology) sorted by score, the first one being the best
+    """
+    genomes = frozenset(genomes)
+    ordered_genomes = sorted(genomes)
+    reference = ordered_genomes[0]
+    slots = len(genomes) - 3
+    all_splits_scored = len(split_scores) == 2 ** (len(genomes) - 1) - len(genomes) - 1
+    # Best splits first: bound computation may then stop after slots consistent ones
+    candidates = sorted(((score, clade) for clade, score in split_scores.items()),
+                        key=lambda candidate: candidate[0])
+    results = []
+
+    def bound(clades, placed):
+        total = trivial_score
+        taken = 0
+        for score, clade in candidates:
+            if taken == slots or (score >= 0 and not all_splits_scored):
+                break
+            restricted = clade & placed
+            if len(restricted) <= 1 or restricted in clades:
+                total += score
+                taken += 1
+        return total
+
+    def score_tree(clades):
+        return trivial_score + sum(split_scores.get(clade, 0) for clade in clades
+                                   if not is_clade_trivial(clade, genomes))
+
+    def threshold():
+        if not results:
+            return None
+        limit = results[0][0] + tolerance
+        if len(results) == max_results:
+            limit = min(limit, results[-1][0])
+        return limit
+
+    def record(score, clades):
+        results.append((score, clades))
+        results.sort(key=lambda result: result[0])
+        best_score = results[0][0]
+        while len(results) > max_results or results[-1][0] > best_score + tolerance:
+            results.pop()
+
+    def search(clades, placed, leaves_left):
+        if not leaves_left:
+            limit = threshold()
+            score = score_tree(clades)
+            if limit is None or score <= limit:
+                record(score, clades)
+            return
+
+        leaf = leaves_left[0]
+        new_placed = placed | {leaf}
+        children = sorted(((bound(child, new_placed), child)
+                           for child in (insert_leaf(clades, clade, leaf) for clade in clades)),
+                          key=lambda child: child[0])
+        for child_bound, child in children:
+            limit = threshold()
+            if limit is not None and child_bound > limit:
+                break
+            search(child, new_placed, leaves_left[1:])
+
+    search(initial_clades(ordered_genomes[1], ordered_genomes[2]),
+           frozenset(ordered_genomes[:3]) - {reference}, ordered_genomes[3:])
+    return [(score, clades_to_topology(clades, reference)) for score, clades in results]
+
+
+def find_best_topologies(breakpoint_graph, genomes=None, split_scorer=get_distribution_split_scores,
+                         tolerance=0, max_results=DEFAULT_MAX_RESULTS):
+    """
+    Finds the best topologies for any number of genomes without enumerating the whole tree space
+    :param breakpoint_graph: given BP graph
+    :param genomes: genomes to build the tree on, all colors of the graph by default
+    :param split_scorer: function from BP graph and genomes to split scores and trivial score,
+    like get_distribution_split_scores or metric_split_scorer(get_ca_metric)
+    :param tolerance: topologies scoring within tolerance from the best one are reported too
+    :param max_results: maximal number of reported topologies
+    :return: list of (score, topology) sorted by score, the first one being the best
+    """
+    genomes = get_genomes(breakpoint_graph) if genomes is None else frozenset(genomes)
+    split_scores, trivial_score = split_scorer(breakpoint_graph, genomes)
+    return search_topologies(split_scores, genomes, trivial_score, tolerance, max_results)
+
+
+if __name__ == '__main__':
+    from random import Random
+
+    from src.graph.branch import compute_tree_score_with_splits
+
+    def test_topology_count():
+        assert (len(list(generate_topologies('ABCD'))) == 3)
+        assert (len(set(generate_topologies('ABCDEF'))) == 105)
+        assert ((('A', 'B'), ('C', 'D')) in generate_topologies('ABCD'))
+
+    def test_search_against_exhaustive():
+        random = Random(0)
+        genomes = frozenset('ABCDEFG')
+        reference = get_reference_genome(genomes)
+        all_clades = [frozenset(clade) for size in range(2, len(genomes) - 1)
+                      for clade in combinations(sorted(genomes - {reference}), size)]
+        for _ in range(20):
+            split_scores = {clade: NEGATIVE * random.randint(0, 10) for clade in random.sample(all_clades, 15)}
+            branches = [((clade, genomes - clade), score) for clade, score in split_scores.items()]
+            exhaustive = sorted(compute_tree_score_with_splits(branches, topology)
+                                for topology in generate_topologies(genomes))
+            found = search_topologies(split_scores, genomes, tolerance=2, max_results=1000)
+            assert (found[0][0] == exhaustive[0])
+            assert ([score for score, _ in found] == [score for score in exhaustive if score <= exhaustive[0] + 2])
+            for score, topology in found:
+                assert (compute_tree_score_with_splits(branches, topology) == score)
+
+    def test_search_with_all_splits_scored():
+        random = Random(1)
+        genomes = frozenset('ABCDEF')
+        reference = get_reference_genome(genomes)
+        for _ in range(20):
+            split_scores = {frozenset(clade): random.randint(-5, 10) for size in range(2, len(genomes) - 1)
+                            for clade in combinations(sorted(genomes - {reference}), size)}
+            branches = [((clade, genomes - clade), score) for clade, score in split_scores.items()]
+            exhaustive = min(compute_tree_score_with_splits(branches, topology)
+                             for topology in generate_topologies(genomes))
+            assert (search_topologies(split_scores, genomes)[0][0] == exhaustive)
+
+    test_topology_count()
+    test_search_against_exhaustive()
+    test_search_with_all_splits_scored()
@@ -7,6 +7,7 @@ from bg.bg_io import GRIMMReader
 from scandir import walk
 
 from .statistics import get_dcj_distance_two_genomes
+from ..dataset_pack import walk_dataset, open_dataset_file
 
 
 PAIRS_TO_CHECK = ('A', 'Left'), ('B', 'Left'), ('C', 'Right'), ('D', 'Right')
@@ -15,11 +16,11 @@ PAIRS_TO_CHECK = ('A', 'Left'), ('B', 'Left'), ('C', 'Right'), ('D', 'Right')
 def validate_datasets(root_directory):
     root_directory = path.abspath(root_directory)
 
-    for root, dirs, files in walk(root_directory):
+    for root, dirs, files in walk_dataset(root_directory, walk):
         for f in files:
             block_file_path = path.join(root, f)
             _, e1, e2 = map(int, path.basename(path.dirname(path.dirname(block_file_path))).split('_'))
-            with open(block_file_path) as block_file:
+            with open_dataset_file(block_file_path) as block_file:
                 breakpoint_graph = GRIMMReader.get_breakpoint_graph(block_file)
                 for genomes in PAIRS_TO_CHECK:
                     leaf_distance = get_dcj_distance_two_genomes(breakpoint_graph, genomes)
@@ -34,7 +35,7 @@ def validate_datasets(root_directory):
 
 if __name__ == '__main__':
     if len(argv) != 2:
-        print('Need only path to the root dir, containing datasets')
+        print('Need only path to the root dir or the pack, containing datasets')
         exit(1)
 
     root_directory = argv[1]
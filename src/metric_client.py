@@ -0,0 +1,56 @@
+__author__ = 'nikita_kartashov'
+
+from sys import argv
+from os import path
+import socket
+
+from .output.stdout_printer import StdOutPrinter
+
+# Kept free of bg/networkx imports: the whole point of the client is to start fast
+DEFAULT_SOCKET_PATH = '/tmp/4genome_tester.sock'
+FIELD_SEPARATOR = '\t'
+ERROR_MARKER = 'ERROR'
+
+
+def request_folders(block_folder_paths, socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Sends folders to a running metric server and streams back its answer
+    :param block_folder_paths: iterable of folder paths, each scored as by compare_methods
+    :param socket_path: path of the Unix socket the server listens on
+    :return: generator of rows, the first one being the header, each row a list of fields
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        request = ''.join('{0}\n'.format(path.abspath(folder)) for folder in block_folder_paths)
+        connection.sendall((request + '\n').encode())
+        with connection.makefile('r') as response:
+            for line in response:
+                yield line.rstrip('\n').split(FIELD_SEPARATOR)
+
+
+def main():
+    if len(argv) < 3:
+        print('Usage: python -m src.metric_client <socket path> <block folder>...')
+        exit(1)
+
+    rows = request_folders(argv[2:], argv[1])
+    header = next(rows)[1:]
+    max_width = max(map(len, header))
+    failed = False
+
+    with StdOutPrinter() as printer:
+        printer.write_header(header, max_width)
+        for row in rows:
+            folder, result = row[0], row[1:]
+            if result[:1] == [ERROR_MARKER]:
+                print('Failed on folder {0}: {1}'.format(folder, result[1]))
+                failed = True
+                continue
+            printer.write_row(path.basename(folder).split('_'), result, max_width)
+
+    if failed:
+        exit(2)
+
+
+if __name__ == '__main__':
+    main()
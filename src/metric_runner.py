@@ -7,8 +7,13 @@ from src.graph.statistics import get_distribution_metric, \
     get_ca_metric, \
     get_mca_metric, \
     get_cumulative_metric_batch
+from src.graph.fast_statistics import ACCELERATED_METRICS
+from src.graph.chain_contraction import CONTRACTED_METRICS
+from src.graph.sampled_patterns import SAMPLED_METRICS
 
-from .metrics.metrics import Metrics
+import numpy as np
+
+from .metrics.metrics import Metrics, ACCELERATED_BACKEND, CONTRACTED_BACKEND, SAMPLED_BACKEND
 
 ANNOTATED_SINGLE_METRICS = (
     # (get_distribution_metric, 'D'),  # Distribution
@@ -21,26 +26,51 @@ ANNOTATED_SINGLE_METRICS = (
 
 ANNOTATED_BATCH_METRICS = ((get_cumulative_metric_batch, 'MCA+'),)
 
-METRICS = Metrics(ANNOTATED_SINGLE_METRICS, ANNOTATED_BATCH_METRICS)
+# Backend -> dict from reference metrics to their implementations on that backend
+BACKEND_METRICS = {ACCELERATED_BACKEND: ACCELERATED_METRICS,
+                   CONTRACTED_BACKEND: CONTRACTED_METRICS,
+                   SAMPLED_BACKEND: SAMPLED_METRICS}
+
+METRICS = Metrics(ANNOTATED_SINGLE_METRICS, ANNOTATED_BATCH_METRICS, BACKEND_METRICS)
 
 A, B, C, D = 'A', 'B', 'C', 'D'
 
 TOPOLOGIES = [((A, B), (C, D)),
               ((A, C), (B, D)),
               ((A, D), (C, B))]
+# Index of the right topology of a file which tree is none of TOPOLOGIES
+NO_RIGHT_TOPOLOGY = -1
 
 # If we have m methods and n trees then function returns score matrix of m lines and n columns
 # def run_metrics(breakpoint_graph):
 # return (((metric(breakpoint_graph, topology), topology) for topology in TOPOLOGIES) for metric in METRICS)
 
 
-def compare_metric_results(breakpoint_graph, right_tree):
-    metric_results = METRICS.run_metrics(breakpoint_graph, TOPOLOGIES)
+def get_right_topology_index(right_tree):
+    return TOPOLOGIES.index(right_tree) if right_tree in TOPOLOGIES else NO_RIGHT_TOPOLOGY
+
+
+def decide_if_right(score_array, right_topology_indices):
+    """
+    A metric is right on a file if the right topology is the only one with the minimal score
+    :param score_array: numpy array of scores, files x metrics x topologies
+    :param right_topology_indices: index of the right topology in TOPOLOGIES for every file
+    :return: numpy array of ones where the metric is right and zeros otherwise, files x metrics
+    """
+    right_topology_indices = np.asarray(right_topology_indices, dtype=int)
+    minimal = score_array == score_array.min(axis=2, keepdims=True)
+    right_is_minimal = minimal[np.arange(len(right_topology_indices)), :, right_topology_indices.clip(0)] & \
+        (right_topology_indices != NO_RIGHT_TOPOLOGY)[:, np.newaxis]
+    return (right_is_minimal & (minimal.sum(axis=2) == 1)).astype(int)
+
+
+def get_accuracies(score_array, right_topology_indices):
+    """
+    :return: numpy array of fractions of files every metric is right on
+    """
+    return decide_if_right(score_array, right_topology_indices).mean(axis=0)
 
-    def decide_if_right(scored_trees):
-        scored_trees = list(scored_trees)
-        min_score = min(scored_trees)[0]
-        trees_with_min_score = list(tree for score, tree in scored_trees if score == min_score)
-        return int(len(trees_with_min_score) == 1 and trees_with_min_score[0] == right_tree)
 
-    return (decide_if_right(score_tuple) for score_tuple in metric_results)
\ No newline at end of file
+def compare_metric_results(breakpoint_graph, right_tree, backend=None, metrics_runner=None):
+    score_matrix = METRICS.score_matrix(breakpoint_graph, TOPOLOGIES, backend, metrics_runner)
+    return iter(decide_if_right(score_matrix[np.newaxis], [get_right_topology_index(right_tree)])[0].tolist())
@@ -0,0 +1,138 @@
+__author__ = 'nikita_kartashov'
+
+from sys import argv
+from os import path, remove
+from io import StringIO
+from itertools import chain
+import logging as log
+import multiprocessing as mp
+import socketserver
+import signal
+
+from bg.bg_io import GRIMMReader
+
+from .compare_methods import run_computation_on_folder, setup_logging, FOLDER_HEADER
+from .metric_runner import compare_metric_results, METRICS, TOPOLOGIES
+from .metric_client import DEFAULT_SOCKET_PATH, FIELD_SEPARATOR, ERROR_MARKER
+
+# Tiny dataset every worker scores once on startup, so the first real request
+# does not pay for lazy imports and first-call overhead
+WARM_UP_BLOCKS = """>A
+1 2 3 4 $
+>B
+1 -2 3 4 $
+>C
+1 2 -3 4 $
+>D
+-1 2 3 -4 $
+"""
+
+
+def warm_up_worker():
+    # Workers replacing dead ones are forked after serve() installs its handler, they should just die on SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    breakpoint_graph = GRIMMReader.get_breakpoint_graph(StringIO(WARM_UP_BLOCKS))
+    list(compare_metric_results(breakpoint_graph, TOPOLOGIES[0]))
+
+
+def score_folder(block_folder_path):
+    """
+    Scores a folder inside a pool worker, never letting an exception kill the request
+    :param block_folder_path: folder with block files
+    :return: tuple of (folder path, metric results or None, error message or None)
+    """
+    try:
+        return block_folder_path, run_computation_on_folder(block_folder_path), None
+    except Exception as e:
+        log.exception('Failed on folder {0}'.format(block_folder_path))
+        return block_folder_path, None, '{0}: {1}'.format(type(e).__name__, e)
+    except SystemExit as e:
+        # Scoring exits on fatal dataset errors, e.g. a missing correct tree, which it has logged already
+        return block_folder_path, None, 'Exited with code {0}, see the server log'.format(e.code)
+
+
+def format_row(block_folder_path, folder_result, error):
+    """
+    Formats a single response line of the protocol
+    :param block_folder_path: folder as it was requested
+    :param folder_result: metric results for the folder
+    :param error: error message if the folder could not be scored
+    :return: tab separated line
+    """
+    if error is not None:
+        fields = (block_folder_path, ERROR_MARKER, error.replace('\n', ' '))
+    else:
+        fields = chain((block_folder_path,), map(str, folder_result))
+    return FIELD_SEPARATOR.join(fields) + '\n'
+
+
+class FolderRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads folder paths one per line until an empty line or EOF, then streams back
+    the header and one result row per folder in the order of the request
+    """
+
+    def handle(self):
+        folders = []
+        for line in self.rfile:
+            folder = line.decode().strip()
+            if not folder:
+                break
+            folders.append(folder)
+
+        header = chain(('folder',), FOLDER_HEADER, METRICS.metric_annotations())
+        self.wfile.write((FIELD_SEPARATOR.join(header) + '\n').encode())
+        for row in self.server.parallel_pool.imap(score_folder, folders):
+            self.wfile.write(format_row(*row).encode())
+            self.wfile.flush()
+
+
+class MetricServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, processes=None):
+        """
+        Constructs a server which keeps a warmed up worker pool between requests
+        :param socket_path: path of the Unix socket to listen on
+        :param processes: number of pool workers, defaults to the number of cores
+        :return: the resulting object
+        """
+        # The pool has to be forked before any handler threads exist
+        self.parallel_pool = mp.Pool(processes, initializer=warm_up_worker)
+        if path.exists(socket_path):
+            remove(socket_path)
+        super().__init__(socket_path, FolderRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.parallel_pool.terminate()
+        self.parallel_pool.join()
+        if path.exists(self.server_address):
+            remove(self.server_address)
+
+
+def interrupt_on_signal(signal_number, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, processes=None):
+    setup_logging()
+    with MetricServer(socket_path, processes) as server:
+        # Installed after the pool is forked, so that only the parent turns a plain kill
+        # into a clean shutdown which removes the socket file, later workers reset it on warm up
+        signal.signal(signal.SIGTERM, interrupt_on_signal)
+        log.info('Serving on {0}'.format(socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    if len(argv) > 3:
+        print('Usage: python -m src.metric_server [socket path] [number of workers]')
+        exit(1)
+
+    socket_path = path.abspath(argv[1]) if len(argv) > 1 else DEFAULT_SOCKET_PATH
+    processes = int(argv[2]) if len(argv) > 2 else None
+    serve(socket_path, processes)
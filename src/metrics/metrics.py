@@ -3,15 +3,60 @@ __author__ = 'nikita_kartashov'
 from operator import itemgetter
 from itertools import chain
 
+import numpy as np
+
+REFERENCE_BACKEND = 'reference'
+ACCELERATED_BACKEND = 'accelerated'
+CONTRACTED_BACKEND = 'contracted'
+# Estimates pattern metrics, so its scores may differ from the reference ones
+SAMPLED_BACKEND = 'sampled'
+BACKENDS = (REFERENCE_BACKEND, ACCELERATED_BACKEND, CONTRACTED_BACKEND, SAMPLED_BACKEND)
+
+
+def get_half_width(score):
+    """
+    :return: confidence half-width of a score estimated by sampling, zero for exact scores
+    """
+    return getattr(score, 'half_width', 0)
+
+
+def get_score_rows(metric_results, topology_number, half_width_rows=None):
+    """
+    Turns results of the metrics into rows of scores, each metric is computed when its row is taken
+    :param metric_results: iterable of scored topologies, one per metric, as returned by Metrics.run_metrics
+    :param topology_number: number of scored topologies
+    :param half_width_rows: list, if given, a row of confidence half-widths of the scores is appended to it
+    along with every row taken
+    :return: generator of numpy arrays of scores, one per metric
+    """
+    for scored_topologies in metric_results:
+        scores = [score for score, _ in scored_topologies]
+        if half_width_rows is not None:
+            half_width_rows.append(np.fromiter(map(get_half_width, scores), float, topology_number))
+        yield np.fromiter(scores, float, topology_number)
+
+
+def stack_score_rows(score_rows, topology_number):
+    """
+    :param score_rows: iterable of rows of scores, e.g. returned by get_score_rows
+    :param topology_number: number of scored topologies
+    :return: numpy array of scores, metrics x topologies
+    """
+    score_rows = list(score_rows)
+    return np.array(score_rows, dtype=float).reshape(len(score_rows), topology_number)
+
 
 class Metrics(object):
-    def __init__(self, single_metrics, batch_metrics):
+    def __init__(self, single_metrics, batch_metrics, backend_metrics=None, backend=REFERENCE_BACKEND):
         """
         Constructs Metrics object, which handles all the metrics
         :param single_metrics: annotated tuple of metrics which
         cannot reuse info on different topologies
         :param batch_metrics: annotated tuple of metrics which
         CAN reuse info on different topologies
+        :param backend_metrics: dict from backend names to dicts from metrics
+        to their implementations on that backend, metrics without one are run as is
+        :param backend: backend used when none is given explicitly
         :return: the resulting object
         """
         self._single_metrics = tuple(map(itemgetter(0), single_metrics))
@@ -20,20 +65,104 @@ class Metrics(object):
         self._metric_annotations = tuple(
             chain(*(map(itemgetter(1), metrics) for metrics in (single_metrics, batch_metrics))))
 
+        if backend_metrics is None:
+            backend_metrics = {}
+
+        def substitute(metrics, implementations):
+            return tuple(implementations.get(metric, metric) for metric in metrics)
+
+        self._backends = {REFERENCE_BACKEND: (self._single_metrics, self._batch_metrics)}
+        for backend_name, implementations in backend_metrics.items():
+            self._backends[backend_name] = (substitute(self._single_metrics, implementations),
+                                            substitute(self._batch_metrics, implementations))
+        self._backend = None
+        self.set_backend(backend)
+
     def metric_number(self):
         return self._metric_number
 
     def metric_annotations(self):
         return self._metric_annotations
 
-    def run_metrics(self, breakpoint_graph, topologies):
-        return chain(*((runner(breakpoint_graph, topologies)
-                        for runner in (self._run_single_metrics, self._run_batch_metrics))))
+    def backend(self):
+        return self._backend
+
+    def backends(self):
+        return tuple(backend for backend in BACKENDS if backend in self._backends)
+
+    def set_backend(self, backend):
+        if backend not in self._backends:
+            raise ValueError('Unknown metric backend {0}, expected one of {1}'.format(backend, ', '.join(self.backends())))
+        self._backend = backend
+
+    def implementations(self, backend=None):
+        """
+        :param backend: backend name, the default one if not given
+        :return: (tuple of single metrics, tuple of batch metrics) run on the backend
+        """
+        return self._backends[self._backend if backend is None else backend]
+
+    def run_metrics(self, breakpoint_graph, topologies, backend=None):
+        single_metrics, batch_metrics = self.implementations(backend)
+        return chain(*((runner(breakpoint_graph, topologies, metrics)
+                        for runner, metrics in ((self._run_single_metrics, single_metrics),
+                                                (self._run_batch_metrics, batch_metrics)))))
+
+    def score_matrix(self, breakpoint_graph, topologies, backend=None, metrics_runner=None, row_iteration=None,
+                     half_width_rows=None):
+        """
+        Runs the metrics into a dense array
+        :param breakpoint_graph: given BP graph
+        :param topologies: topologies to score
+        :param backend: backend to run, the default one if not given
+        :param metrics_runner: function running the metrics like run_metrics does, e.g. by shards
+        :param row_iteration: function of metric annotations and the lazy rows of scores, returning the rows,
+        e.g. FileTrace.traced_iteration, each metric is computed when its row is taken
+        :param half_width_rows: list, if given, rows of confidence half-widths of the scores are appended to it
+        :return: numpy array of scores, metrics x topologies
+        """
+        if metrics_runner is None:
+            metrics_runner = self.run_metrics
+        topologies = tuple(topologies)
+        score_rows = get_score_rows(metrics_runner(breakpoint_graph, topologies, backend), len(topologies),
+                                    half_width_rows)
+        if row_iteration is not None:
+            score_rows = row_iteration(self._metric_annotations, score_rows)
+        return stack_score_rows(score_rows, len(topologies))
+
+    def stack_score_matrices(self, score_matrices, topology_number):
+        """
+        Stacks score matrices of the files of a folder
+        :param score_matrices: iterable of arrays of scores, metrics x topologies, one per file, e.g. returned
+        by score_matrix
+        :param topology_number: number of scored topologies
+        :return: numpy array of scores, files x metrics x topologies
+        """
+        score_matrices = list(score_matrices)
+        return np.array(score_matrices, dtype=float).reshape(len(score_matrices), self._metric_number,
+                                                             topology_number)
+
+    def find_mismatches(self, breakpoint_graph, topologies, score_matrix):
+        """
+        Runs metrics on the reference backend and compares the scores with the checked ones
+        :param breakpoint_graph: given BP graph
+        :param topologies: topologies to score
+        :param score_matrix: checked numpy array of scores, metrics x topologies, e.g. returned by score_matrix
+        :return: list of (metric annotation, list of reference scores, list of checked scores)
+        for every metric which scores differ
+        """
+        reference_matrix = self.score_matrix(breakpoint_graph, topologies, REFERENCE_BACKEND)
+        return [(annotation, reference_scores.tolist(), checked_scores.tolist())
+                for annotation, reference_scores, checked_scores in
+                zip(self._metric_annotations, reference_matrix, score_matrix)
+                if (reference_scores != checked_scores).any()]
 
-    def _run_single_metrics(self, breakpoint_graph, topologies):
+    @staticmethod
+    def _run_single_metrics(breakpoint_graph, topologies, metrics):
         return (((metric(breakpoint_graph, topology), topology)
                  for topology in topologies)
-                for metric in self._single_metrics)
+                for metric in metrics)
 
-    def _run_batch_metrics(self, breakpoint_graph, topologies):
-        return (metric(breakpoint_graph, topologies) for metric in self._batch_metrics)
\ No newline at end of file
+    @staticmethod
+    def _run_batch_metrics(breakpoint_graph, topologies, metrics):
+        return (metric(breakpoint_graph, topologies) for metric in metrics)
@@ -0,0 +1,158 @@
+__author__ = 'nikita_kartashov'
+
+from sys import argv
+from functools import partial
+from collections import deque
+import multiprocessing as mp
+import heapq
+
+from src.graph import fast_statistics
+from src.graph.fast_statistics import get_adjacency_graph
+from src.graph.sampled_patterns import add_scores
+
+from .metric_runner import METRICS, TOPOLOGIES
+from .metrics.metrics import REFERENCE_BACKEND
+
+# Every metric is a sum over the connected components of the graph: traversals, walks and patterns never
+# leave a component, and a component keeps the relative order of its nodes, edges and neighbours. So a graph
+# is split into shards, each a union of whole components, the shards are scored in parallel and the partial
+# scores are summed. Shards are subgraphs of the accelerated index, the reference backend cannot score them.
+
+SHARDS_PER_PROCESS = 4
+# Graphs with fewer nodes are scored in the calling process
+DEFAULT_SHARD_MIN_NODES = 20000
+
+
+def get_unrounded_distance_metric(two_genomes_distance):
+    """
+    Distance metrics round the sum over the pairs, which is only additive before the rounding
+    """
+    def metric(breakpoint_graph, tree_topology):
+        return sum(two_genomes_distance(breakpoint_graph, pair_genomes) for pair_genomes in tree_topology)
+
+    return metric
+
+
+# Metric -> (its additive part scored on shards, function turning the sum of the parts into the score)
+ADDITIVE_PARTS = {
+    fast_statistics.get_bp_distance_metric: (
+        get_unrounded_distance_metric(fast_statistics.get_bp_distance_two_genomes), int),
+    fast_statistics.get_dcj_distance_metric: (
+        get_unrounded_distance_metric(fast_statistics.get_dcj_distance_two_genomes), int),
+}
+
+
+def get_connected_components(graph):
+    """
+    :param graph: AdjacencyGraph
+    :return: list of lists of nodes, components are ordered by their first nodes
+    """
+    visited = set()
+    components = []
+    for node in graph.nodes:
+        if node in visited:
+            continue
+        visited.add(node)
+        component = [node]
+        queue = deque([node])
+        while queue:
+            for neighbour, _, _ in graph.neighbours[queue.popleft()]:
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    component.append(neighbour)
+                    queue.append(neighbour)
+        components.append(component)
+    return components
+
+
+def split_into_shards(breakpoint_graph, shard_number):
+    """
+    Splits the graph into shards of about the same size, largest components are placed first,
+    each into the smallest shard so far
+    :param breakpoint_graph: bg BreakpointGraph or AdjacencyGraph
+    :param shard_number: maximal number of shards
+    :return: list of nonempty AdjacencyGraph shards with nodes relabelled to integers
+    """
+    graph = get_adjacency_graph(breakpoint_graph).relabelled()
+    shard_sizes = [(0, i) for i in range(shard_number)]
+    shard_nodes = [set() for _ in range(shard_number)]
+    for component in sorted(get_connected_components(graph), key=len, reverse=True):
+        size, i = heapq.heappop(shard_sizes)
+        shard_nodes[i].update(component)
+        heapq.heappush(shard_sizes, (size + len(component), i))
+    return graph.partition([nodes for nodes in shard_nodes if nodes])
+
+
+def score_shard(shard, topologies, backend):
+    """
+    Scores a shard inside a pool worker
+    :return: list of lists of partial scores, one list per metric and one score per topology
+    """
+    single_metrics, batch_metrics = METRICS.implementations(backend)
+    return [[ADDITIVE_PARTS.get(metric, (metric,))[0](shard, topology) for topology in topologies]
+            for metric in single_metrics] + \
+           [[score for score, _ in metric(shard, topologies)] for metric in batch_metrics]
+
+
+def run_sharded_metrics(breakpoint_graph, topologies, backend=None, pool=None, shard_min_nodes=DEFAULT_SHARD_MIN_NODES,
+                        shard_number=None):
+    """
+    Runs the metrics the way Metrics.run_metrics does, scoring big graphs by shards in parallel
+    :param breakpoint_graph: given BP graph
+    :param topologies: topologies to score
+    :param backend: backend to run, the default one if not given
+    :param pool: multiprocessing.Pool scoring the shards, without it nothing is sharded
+    :param shard_min_nodes: graphs with fewer nodes are scored without sharding
+    :param shard_number: maximal number of shards, a few per CPU by default
+    :return: iterable of scored topologies, one per metric
+    """
+    backend = METRICS.backend() if backend is None else backend
+    if backend == REFERENCE_BACKEND:
+        raise ValueError('Metrics of the {0} backend cannot be run on shards'.format(REFERENCE_BACKEND))
+    topologies = tuple(topologies)
+    graph = get_adjacency_graph(breakpoint_graph)
+    if pool is None or len(graph.nodes) < shard_min_nodes:
+        return METRICS.run_metrics(graph, topologies, backend)
+
+    if shard_number is None:
+        shard_number = SHARDS_PER_PROCESS * mp.cpu_count()
+    shards = split_into_shards(graph, shard_number)
+    shard_scores = pool.map(partial(score_shard, topologies=topologies, backend=backend), shards)
+    single_metrics, batch_metrics = METRICS.implementations(backend)
+    finalizers = [ADDITIVE_PARTS.get(metric, (None, lambda score: score))[1] for metric in single_metrics] + \
+                 [lambda score: score] * len(batch_metrics)
+    return [[(finalize(add_scores(scores[i][j] for scores in shard_scores)), topology)
+             for j, topology in enumerate(topologies)]
+            for i, finalize in enumerate(finalizers)]
+
+
+if __name__ == '__main__':
+    from time import time
+
+    from bg.bg_io import GRIMMReader
+
+    if len(argv) < 2:
+        print('Usage: python -m src.sharding <blocks file> [processes] [backend]')
+        exit(1)
+
+    processes = int(argv[2]) if len(argv) > 2 else mp.cpu_count()
+    backend = argv[3] if len(argv) > 3 else METRICS.backend()
+    with open(argv[1]) as block_file:
+        breakpoint_graph = GRIMMReader.get_breakpoint_graph(block_file)
+    graph = get_adjacency_graph(breakpoint_graph)
+    print('{0} nodes in {1} connected components'.format(len(graph.nodes), len(get_connected_components(graph))))
+
+    start = time()
+    expected = [list(scored) for scored in METRICS.run_metrics(breakpoint_graph, TOPOLOGIES, backend)]
+    print('Unsharded: {0:.3f}s'.format(time() - start))
+    with mp.Pool(processes) as pool:
+        start = time()
+        sharded = [list(scored) for scored in run_sharded_metrics(breakpoint_graph, TOPOLOGIES, backend, pool, 0,
+                                                                  SHARDS_PER_PROCESS * processes)]
+        print('Sharded over {0} processes: {1:.3f}s'.format(processes, time() - start))
+    assert (sharded == expected)
+
+    shards = split_into_shards(graph, SHARDS_PER_PROCESS * processes)
+    for metric, (additive_part, finalize) in ADDITIVE_PARTS.items():
+        for topology in TOPOLOGIES:
+            assert (finalize(sum(additive_part(shard, topology) for shard in shards)) == metric(graph, topology))
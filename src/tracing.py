@@ -0,0 +1,181 @@
+__author__ = 'nikita_kartashov'
+
+from os import path, getpid, listdir
+from time import time
+from contextlib import contextmanager
+from collections import defaultdict
+import json
+import resource
+
+TRACE_PART_PREFIX = 'trace_'
+TRACE_PART_SUFFIX = '.jsonl'
+FILE_EVENT_NAME = 'file'
+DEFAULT_TOP_FILES = 10
+MICROSECONDS = 10 ** 6
+
+
+def get_peak_rss():
+    """
+    :return: peak resident set size of the current process so far, in kilobytes on Linux
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class FileTrace(object):
+    def __init__(self, block_path):
+        """
+        Collects timings of the processing of a single block file inside a pool worker
+        :param block_path: path to the block file
+        :return: the resulting object
+        """
+        self._block_path = block_path
+        self._start = time()
+        self._spans = []
+        self._graph_size = (None, None)
+        self._start_peak_rss = get_peak_rss()
+
+    @contextmanager
+    def span(self, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self._spans.append((name, start, time() - start))
+
+    def traced_iteration(self, names, iterable):
+        """
+        Yields items of a lazy iterable, recording time it takes to produce each of them
+        :param names: names of the spans, one per item
+        :param iterable: iterable, e.g. of metric results
+        :return: generator of items
+        """
+        iterator = iter(iterable)
+        for name in names:
+            with self.span(name):
+                item = next(iterator)
+            yield item
+
+    def traced_call(self, name, function):
+        """
+        Wraps a function, recording time every call of it takes
+        :param name: name of the spans
+        :param function: function to trace
+        :return: traced function
+        """
+        def traced(*arguments):
+            with self.span(name):
+                return function(*arguments)
+
+        return traced
+
+    def set_graph(self, breakpoint_graph):
+        self._graph_size = (len(breakpoint_graph.bg), breakpoint_graph.bg.number_of_edges())
+
+    def record(self, trace_directory):
+        """
+        Appends the trace to the part file of the current worker
+        :param trace_directory: directory with part files of all workers
+        """
+        nodes, edges = self._graph_size
+        peak_rss = get_peak_rss()
+        trace_record = {'path': self._block_path,
+                        'pid': getpid(),
+                        'start': self._start,
+                        'duration': time() - self._start,
+                        'nodes': nodes,
+                        'edges': edges,
+                        # The peak never goes down, so a file only shows by how much it raised the peak
+                        # of the worker, which is zero for files smaller than some file before them
+                        'worker_peak_rss': peak_rss,
+                        'peak_rss_growth': peak_rss - self._start_peak_rss,
+                        'spans': self._spans}
+        part_path = path.join(trace_directory, '{0}{1}{2}'.format(TRACE_PART_PREFIX, getpid(), TRACE_PART_SUFFIX))
+        with open(part_path, 'a') as part_file:
+            part_file.write(json.dumps(trace_record) + '\n')
+
+
+@contextmanager
+def trace_file(block_path, trace_directory):
+    """
+    Traces processing of a block file, the trace is only stored if tracing is enabled
+    :param block_path: path to the block file
+    :param trace_directory: directory for the part files, None disables tracing
+    :return: context manager yielding FileTrace
+    """
+    file_trace = FileTrace(block_path)
+    yield file_trace
+    if trace_directory is not None:
+        file_trace.record(trace_directory)
+
+
+def read_trace_records(trace_directory):
+    for part_name in sorted(listdir(trace_directory)):
+        if not (part_name.startswith(TRACE_PART_PREFIX) and part_name.endswith(TRACE_PART_SUFFIX)):
+            continue
+        with open(path.join(trace_directory, part_name)) as part_file:
+            for line in part_file:
+                yield json.loads(line)
+
+
+def to_trace_events(trace_records):
+    """
+    Converts trace records to events of the Chrome trace event format, one track per worker
+    :param trace_records: iterable of records written by FileTrace.record
+    :return: list of complete ('X') events
+    """
+    def complete_event(name, start, duration, pid, args=None):
+        event = {'name': name, 'ph': 'X', 'cat': 'compare_methods',
+                 'ts': int(start * MICROSECONDS), 'dur': int(duration * MICROSECONDS), 'pid': pid, 'tid': pid}
+        if args is not None:
+            event['args'] = args
+        return event
+
+    events = []
+    for trace_record in trace_records:
+        args = dict((key, trace_record[key])
+                    for key in ('path', 'nodes', 'edges', 'worker_peak_rss', 'peak_rss_growth'))
+        events.append(complete_event(FILE_EVENT_NAME, trace_record['start'], trace_record['duration'],
+                                     trace_record['pid'], args))
+        events.extend(complete_event(name, start, duration, trace_record['pid'])
+                      for name, start, duration in trace_record['spans'])
+    return events
+
+
+def summarise(trace_records, top=DEFAULT_TOP_FILES):
+    """
+    Lists the slowest files and the busy time of every worker
+    :param trace_records: list of records written by FileTrace.record
+    :param top: number of the slowest files to list
+    :return: list of summary lines
+    """
+    lines = ['Slowest files:']
+    for trace_record in sorted(trace_records, key=lambda r: r['duration'], reverse=True)[:top]:
+        spans = ', '.join('{0}={1:.3f}s'.format(name, duration) for name, _, duration in trace_record['spans'])
+        lines.append('{0:.3f}s\t{1}\tnodes={2}\tedges={3}\tworker_peak_rss={4}KB\tpeak_rss_growth={5}KB\t{6}'.
+                     format(trace_record['duration'], trace_record['path'], trace_record['nodes'],
+                            trace_record['edges'], trace_record['worker_peak_rss'], trace_record['peak_rss_growth'],
+                            spans))
+
+    busy_time = defaultdict(float)
+    file_count = defaultdict(int)
+    for trace_record in trace_records:
+        busy_time[trace_record['pid']] += trace_record['duration']
+        file_count[trace_record['pid']] += 1
+    lines.append('Worker load:')
+    lines.extend('pid={0}\tfiles={1}\tbusy={2:.3f}s'.format(pid, file_count[pid], busy_time[pid])
+                 for pid in sorted(busy_time, key=busy_time.get, reverse=True))
+    return lines
+
+
+def merge_traces(trace_directory, trace_path, top=DEFAULT_TOP_FILES):
+    """
+    Merges part files of all workers into a single Chrome trace
+    :param trace_directory: directory with part files
+    :param trace_path: path of the resulting JSON, loadable by chrome://tracing or Perfetto
+    :param top: number of the slowest files to summarise
+    :return: list of summary lines
+    """
+    trace_records = list(read_trace_records(trace_directory))
+    with open(trace_path, 'w') as trace_output:
+        json.dump({'traceEvents': to_trace_events(trace_records), 'displayTimeUnit': 'ms'}, trace_output)
+    return summarise(trace_records, top)